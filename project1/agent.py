@@ -0,0 +1,36 @@
+import argparse
+import xmlrpc.server
+
+import run_cluster
+
+basePort = 6000
+
+
+# AgentRPCServer: Load agent for run_cluster.py --agents. It runs a share of
+# each testKVS phase on this host and returns the results to run_cluster.
+class AgentRPCServer:
+    def __init__(self, clusterHost=None):
+        self.clusterHost = clusterHost
+
+    # drive: Run one worker's share of a testKVS phase.
+    def drive(self, spec):
+        if self.clusterHost is not None:
+            spec["clients"] = [[t, addr.replace("localhost", self.clusterHost)]
+                               for t, addr in spec["clients"]]
+        return run_cluster.driveWorker(spec)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''Load agent that drives part of a
+                                     testKVS run for run_cluster.py --agents.''')
+
+    parser.add_argument('-p', '--port', nargs=1, type=int, metavar='P',
+                        help='Port to listen on', dest='port', default=[basePort])
+    parser.add_argument('--cluster-host', nargs=1, type=str, metavar='H',
+                        help='Host the clients run on, when not this one', dest='clusterHost',
+                        default=[None])
+
+    args = parser.parse_args()
+
+    server = xmlrpc.server.SimpleXMLRPCServer(("0.0.0.0", args.port[0]), logRequests=False)
+    server.register_instance(AgentRPCServer(args.clusterHost[0]))
+    server.serve_forever()
@@ -1,30 +1,375 @@
 import argparse
+import collections
+import socket
+import threading
+import time
 import xmlrpc.client
 import xmlrpc.server
+from socketserver import ThreadingMixIn
+from xmlrpc.server import SimpleXMLRPCServer
+
+from shared import rpc
+from shared.cache import ByteLRUCache
+from shared.partition import partition_of
+from shared.rpc import Deadline, ERR_DEADLINE
 
 clientId = 0
 basePort = 7000
 
-frontend = xmlrpc.client.ServerProxy("http://localhost:8001")
+# Frontend addresses; with a Raft-replicated group, requests follow
+# ERR_NOTLEADER redirects and move on to the next frontend when one is down
+frontends = ["http://localhost:8001"]
+frontendAddr = frontends[0]
+
+
+class SimpleThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    # Concurrent callers would overflow the default listen backlog of 5
+    request_queue_size = 128
+
+
+# Batcher: Coalesces concurrent requests to one frontend into batch calls.
+# Up to senders batches are in flight at once, and requests that arrive
+# meanwhile (or within window seconds) go out together in the next one.
+# Each key always goes through the same sender, one batch at a time, and a
+# batch never holds the same key twice, so puts of a key keep their order.
+class Batcher:
+    def __init__(self, send, window=0, limit=1000, senders=4):
+        self.send = send
+        self.window = window
+        self.limit = limit
+        self.cond = threading.Condition()
+        self.pending = [collections.deque() for _ in range(senders)]
+        for i in range(senders):
+            thread = threading.Thread(target=self.run, args=(i,))
+            thread.daemon = True
+            thread.start()
+
+    # submit: Queue a request and wait for its result. None if the batch
+    # failed or had no answer for it; the caller then makes a single call.
+    def submit(self, key, value, deadline):
+        slot = {"key": key, "value": value, "deadline": deadline,
+                "done": threading.Event(), "result": None}
+        with self.cond:
+            self.pending[hash(key) % len(self.pending)].append(slot)
+            self.cond.notify_all()
+        slot["done"].wait(deadline.remaining())
+        return slot["result"]
+
+    # run: Sender i, which sends the batches of the keys routed to it.
+    def run(self, i):
+        pending = self.pending[i]
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(pending) > 0)
+            if self.window > 0:
+                time.sleep(self.window)
+            batch = []
+            keys = set()
+            with self.cond:
+                while len(pending) > 0 and len(batch) < self.limit and \
+                        pending[0]["key"] not in keys:
+                    slot = pending.popleft()
+                    keys.add(slot["key"])
+                    batch.append(slot)
+            if len(batch) == 0:
+                continue
+            try:
+                results = self.send(batch, max(slot["deadline"].remaining() for slot in batch))
+            except Exception:
+                results = {}
+            for slot in batch:
+                slot["result"] = results.get(slot["key"])
+                slot["done"].set()
 
 class ClientRPCServer:
-    def put(self, key, value):
-        return frontend.put(key, value)
+    def __init__(self, timeout=5.0, direct=False, batch=False, batch_window=0, near_cache=0):
+        # Budget for requests that arrive without one (seconds)
+        self.timeout = timeout
+        self.mLock = threading.Lock()
+        self.metrics = {"deadline_expired": 0, "direct_gets": 0, "batches": 0, "batched": 0,
+                        "near_hits": 0, "revokes": 0}
+        # Partitioned frontends: owner addresses by partition (empty for a
+        # single frontend or a Raft group), fetched on first use and again
+        # whenever a frontend answers ERR_WRONGFE.
+        self.partitions = None
+        self.epoch = 0
+        # Requests are served concurrently. ServerProxy objects are not
+        # thread safe, so each call borrows one from a per-address pool.
+        self.pLock = threading.Lock()
+        self.pools = {}
+        self.pool_size = 16
+        # Batching: concurrent puts and gets to the same frontend are sent
+        # together through its put_many/get_many, one Batcher per both.
+        self.batch = batch
+        self.batch_window = batch_window
+        self.batchers = {}
+        # Near cache: key -> (result, lease expiry) for gets made under a
+        # frontend lease, served locally until the lease runs out or the
+        # frontend revokes it. A revoke bumps the key's generation so that a
+        # lease_get already in flight does not cache what it read.
+        self.near = ByteLRUCache(near_cache) if near_cache > 0 else None
+        self.nLock = threading.Lock()
+        self.generations = {}
+        self.holder = "http://localhost:" + str(basePort + clientId)
+        # Direct mode: gets go straight to a reader server (chain tail or
+        # primary) named in the map, skipping the frontend hop. Puts still go
+        # through the frontend, which assigns versions and keeps the log.
+        self.direct = direct
+        self.readers = []
+
+    def count(self, name, n=1):
+        with self.mLock:
+            self.metrics[name] = self.metrics.get(name, 0) + n
+
+    # refresh: Fetch the partition map from the given (or current) frontend.
+    def refresh(self, addr=None):
+        try:
+            membership = rpc.proxy(addr or frontendAddr, self.timeout).getMembership()
+            self.partitions = membership["frontends"]
+            self.epoch = membership["epoch"]
+            self.readers = membership.get("readers", [])
+        except OSError:
+            self.partitions = []
+            self.readers = []
+
+    # route: Address of the frontend that owns key.
+    def route(self, key):
+        if len(self.partitions) == 0:
+            return frontendAddr
+        return self.partitions[partition_of(key, len(self.partitions))]
+
+    def checkout(self, addr):
+        with self.pLock:
+            free = self.pools.setdefault(addr, [])
+            if len(free) > 0:
+                return free.pop()
+        return rpc.proxy(addr)
+
+    def checkin(self, addr, proxy):
+        with self.pLock:
+            if len(self.pools[addr]) < self.pool_size:
+                self.pools[addr].append(proxy)
+
+    # batched: Send a put or get through the frontend's batcher. None falls
+    # back to a single call (no answer, or a redirect to follow).
+    def batched(self, method, key, value, deadline):
+        if self.partitions is None:
+            self.refresh()
+        addr = self.route(key)
+        with self.pLock:
+            if (method, addr) not in self.batchers:
+                self.batchers[(method, addr)] = Batcher(
+                    lambda batch, budget: self.send_batch(method, addr, batch, budget),
+                    self.batch_window)
+            batcher = self.batchers[(method, addr)]
+        result = batcher.submit(str(key), value, deadline)
+        if result is None and deadline.expired():
+            result = ERR_DEADLINE
+        if result is None or (not rpc.is_binary(result) and
+                               result.startswith(("ERR_NOTLEADER:", "ERR_WRONGFE:"))):
+            return None
+        if result == ERR_DEADLINE:
+            self.count("deadline_expired")
+        return result
+
+    def send_batch(self, method, addr, batch, budget):
+        proxy = self.checkout(addr)
+        try:
+            rpc.set_timeout(proxy, budget)
+            if method == "put":
+                results = proxy.put_many({slot["key"]: slot["value"] for slot in batch}, budget)
+            else:
+                results = proxy.get_many([slot["key"] for slot in batch], budget)
+        finally:
+            self.checkin(addr, proxy)
+        self.count("batches")
+        self.count("batched", len(batch))
+        return results
+
+    # direct_get: Read key from the reader server. ERR_EPOCH means our map is
+    # older than the server's, so refresh it and try again. None means no
+    # reader could answer and the frontend should.
+    def direct_get(self, key, deadline):
+        if self.partitions is None:
+            self.refresh()
+        for _ in range(2):
+            if len(self.readers) == 0 or deadline.expired():
+                return None
+            addr = self.readers[0]
+            server = self.checkout(addr)
+            try:
+                rpc.set_timeout(server, deadline.remaining())
+                value = server.get_direct(str(key), self.epoch)
+            except OSError:
+                self.refresh()
+                return None
+            finally:
+                self.checkin(addr, server)
+            if value != "ERR_EPOCH":
+                self.count("direct_gets")
+                return "ERR_KEY" if value == "ERR_KEY" else rpc.found(key, value)
+            self.refresh()
+        return None
+
+    # call: Forward to the frontend with the remaining budget, both as the
+    # socket timeout and as the budget the frontend enforces on its own hops.
+    # A frontend that is not the leader answers ERR_NOTLEADER:<leader>, and
+    # one that is down (or does not know the leader) sends us to the next.
+    # A partitioned frontend that does not own the key answers ERR_WRONGFE.
+    def call(self, method, key, *args, budget=None):
+        global frontendAddr
+        deadline = Deadline(self.timeout if budget is None else budget)
+        if self.partitions is None:
+            self.refresh()
+        while True:
+            addr = self.route(key)
+            target = self.checkout(addr)
+            try:
+                rpc.set_timeout(target, deadline.remaining())
+                result = getattr(target, method)(key, *args, deadline.remaining())
+            except socket.timeout:
+                result = ERR_DEADLINE
+            except OSError:
+                if len(frontends) == 1:
+                    raise
+                result = "ERR_NOTLEADER:"
+            finally:
+                self.checkin(addr, target)
+            if rpc.is_binary(result):
+                break
+            if str(result).startswith("ERR_WRONGFE:") and not deadline.expired():
+                self.refresh(result.split(':', 1)[1])
+                continue
+            if not str(result).startswith("ERR_NOTLEADER:"):
+                break
+            if deadline.expired():
+                result = ERR_DEADLINE
+                break
+            addr = result.split(':', 1)[1]
+            if addr == "":
+                current = frontends.index(frontendAddr) if frontendAddr in frontends else -1
+                addr = frontends[(current + 1) % len(frontends)]
+                time.sleep(.05)
+            frontendAddr = addr
+        if result == ERR_DEADLINE:
+            self.count("deadline_expired")
+        return result
+
+    # near_get: get through the near cache.
+    def near_get(self, key, deadline):
+        key = str(key)
+        hit, entry = self.near.get(key)
+        if hit and entry[1] > time.monotonic():
+            self.count("near_hits")
+            return entry[0]
+        with self.nLock:
+            generation = self.generations.get(key, 0)
+        # Our lease starts no later than the frontend's
+        start = time.monotonic()
+        result = self.call("lease_get", key, self.holder, budget=deadline.remaining())
+        if not isinstance(result, list):
+            return result
+        value, lease = result
+        if lease > 0:
+            with self.nLock:
+                if self.generations.get(key, 0) == generation:
+                    self.near.put(key, (value, start + lease))
+        return value
+
+    # revoke: The frontend revokes our lease on key before a put of it.
+    def revoke(self, key):
+        with self.nLock:
+            self.generations[key] = self.generations.get(key, 0) + 1
+            if self.near is not None:
+                self.near.discard(key)
+        self.count("revokes")
+        return "Success"
+
+    def put(self, key, value, budget=None):
+        deadline = Deadline(self.timeout if budget is None else budget)
+        if self.batch:
+            result = self.batched("put", key, value, deadline)
+            if result is not None:
+                return result
+        return self.call("put", key, value, budget=deadline.remaining())
+
+    def get(self, key, budget=None):
+        deadline = Deadline(self.timeout if budget is None else budget)
+        if self.near is not None:
+            return self.near_get(key, deadline)
+        if self.direct:
+            result = self.direct_get(key, deadline)
+            if result is not None:
+                return result
+        if self.batch:
+            result = self.batched("get", key, None, deadline)
+            if result is not None:
+                return result
+        return self.call("get", key, budget=deadline.remaining())
+
+    # get_many: get a batch of keys (a scan), with one call to each frontend
+    # that owns some of them. Keys it redirects or cannot answer are then
+    # fetched one at a time. Returns str(key) -> result.
+    def get_many(self, keys, budget=None):
+        deadline = Deadline(self.timeout if budget is None else budget)
+        if self.partitions is None:
+            self.refresh()
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.route(key), []).append(str(key))
+        results = {}
+        for addr, group in groups.items():
+            target = self.checkout(addr)
+            try:
+                rpc.set_timeout(target, deadline.remaining())
+                results.update(target.get_many(group, deadline.remaining()))
+            except OSError:
+                pass
+            finally:
+                self.checkin(addr, target)
+        for key in keys:
+            result = results.get(str(key))
+            if result is None or (not rpc.is_binary(result) and
+                                   result.startswith(("ERR_NOTLEADER:", "ERR_WRONGFE:"))):
+                if deadline.expired():
+                    results[str(key)] = ERR_DEADLINE
+                else:
+                    results[str(key)] = self.call("get", key, budget=deadline.remaining())
+        return results
 
-    def get(self, key):
-        return frontend.get(key)
+    def getMetrics(self):
+        with self.mLock:
+            return dict(self.metrics)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = '''To be added.''')
 
     parser.add_argument('-i', '--id', nargs=1, type=int, metavar='I',
                         help='Client id (required)', dest='clientId', required=True)
+    parser.add_argument('-t', '--timeout', nargs=1, type=float, metavar='T',
+                        help='Default request budget in seconds', dest='timeout', default=[5.0])
+    parser.add_argument('-f', '--frontends', nargs=1, type=str, metavar='IDS',
+                        help='Comma-separated frontend ids to use, e.g. 0,1,2', dest='frontends', default=["0"])
+    parser.add_argument('-d', '--direct', action='store_true',
+                        help='Read from the chain tail or primary directly instead of through the frontend',
+                        dest='direct')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='Coalesce concurrent puts and gets into batched frontend calls',
+                        dest='batch')
+    parser.add_argument('--batch-window', nargs=1, type=float, metavar='MS',
+                        help='Extra milliseconds a batch waits to fill up', dest='batchWindow', default=[0])
+    parser.add_argument('-c', '--near-cache', nargs=1, type=int, metavar='B',
+                        help='Bytes of leased gets to serve locally (0 disables)', dest='nearCache', default=[0])
 
     args = parser.parse_args()
 
     clientId = args.clientId[0]
+    frontends = ["http://localhost:" + str(8001 + int(i)) for i in args.frontends[0].split(',')]
+    frontendAddr = frontends[0]
 
-    server = xmlrpc.server.SimpleXMLRPCServer(("localhost", basePort + clientId))
-    server.register_instance(ClientRPCServer())
+    server = SimpleThreadedXMLRPCServer(("localhost", basePort + clientId))
+    server.register_instance(ClientRPCServer(args.timeout[0], args.direct,
+                                             args.batch, args.batchWindow[0] / 1000,
+                                             args.nearCache[0]))
 
     server.serve_forever()
@@ -1,10 +1,22 @@
+import argparse
+import os
 import xmlrpc.client
 import xmlrpc.server
+import socket
 import time
 import threading
 from socketserver import ThreadingMixIn
 from xmlrpc.server import SimpleXMLRPCServer
 import random
+import collections
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from shared import rpc
+from shared.cache import ByteLRUCache
+from shared.logstore import LogStore
+from shared.partition import partition_of
+from shared.raft import RaftNode
+from shared.rpc import Deadline, DeadlineExceeded, ERR_DEADLINE
 
 # All Servers
 kvsServers = dict()
@@ -15,130 +27,1461 @@ serverLocks = dict()
 requests = list()
 baseAddr = "http://localhost:"
 baseServerPort = 9000
+frontendPort = 8001
+# Replica selection policies for get
+READ_POLICIES = ("random", "p2c", "least")
+# Read cache modes: "off", or "serve" to answer cache hits without a server
+CACHE_MODES = ("off", "serve")
+# Master log contents: versions and values, or versions only ("metadata")
+LOG_MODES = ("values", "metadata")
+# Write path: frontend sends each put to every server ("fanout"), to the
+# head of a chain of the active servers ("chain"), or to a primary that ships
+# it to the backups asynchronously ("primary")
+REPLICATION_MODES = ("fanout", "chain", "primary")
 
 
 class SimpleThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
-    pass
+    # Concurrent callers would overflow the default listen backlog of 5
+    request_queue_size = 128
 
 
 class FrontendRPCServer:
-    def __init__(self):
+    def __init__(self, request_timeout=5.0, rpc_timeout=1.0, repair_timeout=30.0,
+                 read_policy="random", hedge_percentile=0, hedge_ratio=0.05,
+                 cache_mode="off", cache_bytes=64 * 1024 * 1024, log_dir=None,
+                 log_mode="values", replication="fanout", max_lag=1000, frontend_id=0,
+                 peers=None, raft_dir=None, frontends=None, lease=0):
         # Key Lock for dicts
         self.kLock = threading.Lock()
         # Add/Remove Server lock for kvsServers and activeServers
         self.wLock = threading.Lock()
         # Per-key Locking
         self.key_to_lock = {}
-        # Master Log
-        self.log = {}
+        # Master Log: key -> (version, value), spilled to an on-disk LogStore
+        # when log_dir is given. In "metadata" log_mode the value is left out
+        # and repairs pull values from an up-to-date peer server instead.
+        logName = "frontend.log" if peers is None and frontends is None else f"frontend-{frontend_id}.log"
+        self.log = {} if log_dir is None else LogStore(os.path.join(log_dir, logName))
+        self.log_mode = log_mode
+        # Puts that have written the log but not finished their fan-out.
+        # Repairs wait for this to drain so the copy includes them.
+        self.inflight = 0
+        self.idle = threading.Condition(self.kLock)
+        # Hinted handoff: serverId -> keys of puts that server missed since it
+        # last went inactive. Replayed when the heartbeat sees it again; no
+        # entry (or more than hint_limit keys) means a full repair instead.
+        self.hints = {}
+        self.hint_limit = 100000
+        self.replication = replication
+        # Primary-backup: the primary's operation log may run at most max_lag
+        # puts ahead of the backups. seq numbers every put so that failover
+        # can promote the backup that has applied the most.
+        self.primary = None
+        self.max_lag = max_lag
+        self.seq = 0
+        # Chain replication: idle proxies to each chain head (id -> list),
+        # so that puts go down the chain together instead of queueing on
+        # serverLocks.
+        self.cLock = threading.Lock()
+        self.chain_proxies = {}
+        # Keys per stage/put_many call when copying the log to a server
+        self.repair_batch = 10000
+        # Keys per put_many call to a server in bulk_load, few enough that
+        # heartbeats still get the server's lock in between
+        self.bulk_batch = 1000
+        # Deadline parameters (seconds). request_timeout is the budget for
+        # requests that arrive without one, rpc_timeout caps a single server
+        # call and repair_timeout caps full-log transfers.
+        self.request_timeout = request_timeout
+        self.rpc_timeout = rpc_timeout
+        self.repair_timeout = repair_timeout
+        # Counters exposed through getMetrics
+        self.mLock = threading.Lock()
+        self.metrics = {"deadline_expired": 0, "rpc_timeouts": 0, "rpc_errors": 0,
+                        "hedges": 0, "hedge_wins": 0, "hints_recorded": 0,
+                        "hints_replayed": 0, "full_repairs": 0, "failovers": 0,
+                        "leases_granted": 0, "leases_revoked": 0, "lease_waits": 0}
+        # Replica selection: per-server EWMA of RPC latency (seconds) and the
+        # number of calls queued or in flight, both maintained by call.
+        self.read_policy = read_policy
+        self.ewma_alpha = 0.2
+        self.ewma = {}
+        self.outstanding = {}
+        # Hedged reads: if a get has not answered within hedge_percentile of
+        # recent get latency (0 disables), send it to a second replica too.
+        # Each get earns hedge_ratio tokens and a hedge spends one, so hedges
+        # stay under that fraction of reads.
+        self.hedge_percentile = hedge_percentile
+        self.hedge_ratio = hedge_ratio
+        self.hedge_tokens = 0.0
+        self.hedge_delay = None
+        self.read_samples = 0
+        self.read_latencies = collections.deque(maxlen=1000)
+        self.readPool = ThreadPoolExecutor(max_workers=64)
+        # Read cache, kept write-through by put while cache_mode is "serve"
+        self.cache_mode = cache_mode
+        self.read_cache = ByteLRUCache(cache_bytes)
+        # Client near caches: lease_get grants the caller a lease of this many
+        # seconds (0 grants none) on the key, and a put of the key revokes
+        # every unexpired lease before it is acknowledged.
+        # leases: key -> holder address -> expiry (monotonic). The heartbeat
+        # thread prunes expired leases every lease_prune seconds.
+        self.lease = lease
+        self.leases = {}
+        self.revoke_timeout = 0.2
+        self.lease_prune = 1.0
+        self.pruned = time.monotonic()
         # Heartbeat parameters
         self.heartbeat_rate = 10  # Rate = # heartbeats per second
         self.heartbeat_max = 3  # Number of allowed heartbeats till we mark it as dead
+        self.heartbeat_timeout = 0.5
+        # Heartbeat thread's proxies: serverId -> proxy
+        self.pulses = {}
+        # Servers join is copying the log to: inactive, but not for the
+        # heartbeat to repair
+        self.joining = set()
+        # Replicated frontend group (peers lists the frontend ids): puts and
+        # membership go through a Raft log before they take effect, and only
+        # the leader serves clients. assigned holds versions the leader has
+        # handed out but not yet applied; leader_term is the term whose
+        # takeover (reconciling the servers) is done.
+        self.assigned = {}
+        self.leader_term = 0
+        self.raft = None
+        # Partitioned frontends (frontends lists their ids): each owns the
+        # keys that partition_of maps to it, with their log and versions, and
+        # writes them to every server. The first frontend coordinates server
+        # membership: it numbers each change with an epoch and pushes it to
+        # the others, which also poll it in case a push was lost.
+        self.frontend_id = frontend_id
+        self.partitions = None
+        self.coordinator = None
+        self.epoch = 0
+        # Direct reads: servers clients may read without the frontend, as
+        # last announced. Without partitions every change starts a new epoch
+        # that is pushed to the servers, which refuse reads from older ones.
+        # Readers hold a lease of reader_lease seconds, renewed by the
+        # heartbeat, so one that misses the change stops serving within it.
+        # Changes are pushed by a thread of their own (republish wakes it)
+        # on its own proxies. reader_leases: serverId -> latest time
+        # (monotonic) it may still hold a lease granted to it.
+        self.eLock = threading.Lock()
+        self.published = []
+        self.reader_lease = 1.0
+        self.reader_leases = {}
+        self.republish = threading.Event()
+        self.announces = {}
+        if frontends is not None:
+            self.partitions = [baseAddr + str(frontendPort + i) for i in frontends]
+            self.coordinator = self.partitions[0]
+            self.me = baseAddr + str(frontendPort + frontend_id)
+        if peers is not None:
+            self.raft = RaftNode(frontend_id, {i: baseAddr + str(frontendPort + i) for i in peers},
+                                 self.apply, raft_dir, self.snapshot, self.restore)
         self.start_heartbeat()
 
 
+    def count(self, name, n=1):
+        with self.mLock:
+            self.metrics[name] = self.metrics.get(name, 0) + n
+
+    # raft_vote, raft_append, raft_snapshot: Raft RPCs between frontends.
+    def raft_vote(self, term, candidateId, lastIndex, lastTerm):
+        return self.raft.raft_vote(term, candidateId, lastIndex, lastTerm)
+
+    def raft_append(self, term, leaderId, prevIndex, prevTerm, entries, leaderCommit):
+        return self.raft.raft_append(term, leaderId, prevIndex, prevTerm, entries, leaderCommit)
+
+    def raft_snapshot(self, term, leaderId, index, lastTerm, data):
+        return self.raft.raft_snapshot(term, leaderId, index, lastTerm, data)
+
+    # snapshot: What Raft compacts applied commands into: [entries, seq,
+    # servers], with the master log's entries as a "load" command carries
+    # them.
+    def snapshot(self):
+        with self.kLock:
+            entries = [[key, version] + ([value] if self.log_mode == "values" else [])
+                       for key, (version, value) in self.log.items()]
+            return [entries, self.seq, sorted(kvsServers.keys())]
+
+    # restore: Install a snapshot on a follower or a restarted frontend:
+    # merge its entries into the master log by version and adopt its servers.
+    def restore(self, snapshot):
+        entries, seq, servers = snapshot
+        self.apply(["load", entries, seq])
+        with self.kLock:
+            for serverId in servers:
+                if serverId not in kvsServers:
+                    kvsServers[serverId] = rpc.proxy(
+                        baseAddr + str(baseServerPort + serverId), self.rpc_timeout)
+                    serverLocks[serverId] = threading.Lock()
+                    activeServers.add(serverId)
+            for serverId in list(kvsServers.keys()):
+                if serverId not in servers:
+                    kvsServers.pop(serverId, None)
+                    serverLocks.pop(serverId, None)
+                    activeServers.discard(serverId)
+
+    # apply: Apply a committed Raft command on this frontend. The leader
+    # already changed membership itself, so only commands from before its
+    # election are applied to membership there.
+    def apply(self, command):
+        if command[0] == "put":
+            key, version, seq = command[1:4]
+            with self.kLock:
+                entry = self.log.get(key)
+                if entry is None or version > entry[0]:
+                    self.log[key] = (version, command[4] if self.log_mode == "values" else None)
+                if self.assigned.get(key, 0) <= version:
+                    self.assigned.pop(key, None)
+                self.seq = max(self.seq, seq)
+        elif command[0] == "load":
+            with self.kLock:
+                entries = {}
+                for loaded in command[1]:
+                    key, version = loaded[0], loaded[1]
+                    entry = self.log.get(key)
+                    if entry is None or version > entry[0]:
+                        entries[key] = (version, loaded[2] if self.log_mode == "values" else None)
+                    if self.assigned.get(key, 0) <= version:
+                        self.assigned.pop(key, None)
+                self.log.update(entries)
+                self.seq = max(self.seq, command[2])
+        elif command[0] in ("add", "remove") and not self.raft.is_leader():
+            serverId = command[1]
+            with self.kLock:
+                if command[0] == "add" and serverId not in kvsServers:
+                    kvsServers[serverId] = rpc.proxy(
+                        baseAddr + str(baseServerPort + serverId), self.rpc_timeout)
+                    serverLocks[serverId] = threading.Lock()
+                    activeServers.add(serverId)
+                elif command[0] == "remove":
+                    kvsServers.pop(serverId, None)
+                    serverLocks.pop(serverId, None)
+                    activeServers.discard(serverId)
+
+    # commit: Replicate a command through Raft and wait until it is applied
+    # here. True right away without a frontend group.
+    def commit(self, command, deadline):
+        if self.raft is None:
+            return True
+        proposed = self.raft.propose(command)
+        return proposed is not None and self.raft.wait(proposed[0], proposed[1], deadline)
+
+    # lead: None if this frontend may serve the request: no frontend group,
+    # or the leader once its election no-op is applied (and, for reads, while
+    # it holds the lease). Otherwise waits for that within the deadline and
+    # then returns ERR_NOTLEADER:<leader address, if known>.
+    def lead(self, deadline, lease=False):
+        if self.raft is None:
+            return None
+        while True:
+            if self.raft.is_leader() and (not lease or self.raft.has_lease()):
+                return None
+            leader = self.raft.leader_addr()
+            if deadline.expired() or (leader != "" and leader != self.raft.addrs[self.raft.id]):
+                return "ERR_NOTLEADER:" + leader
+            time.sleep(.01)
+
+    # owner: ERR_WRONGFE:<owner address> for a key another partitioned
+    # frontend owns, else None.
+    def owner(self, key):
+        if self.partitions is None:
+            return None
+        owner = self.partitions[partition_of(key, len(self.partitions))]
+        return None if owner == self.me else "ERR_WRONGFE:" + owner
+
+    # coordinate: ERR_WRONGFE:<coordinator> for membership changes sent to a
+    # partitioned frontend other than the coordinator, else None.
+    def coordinate(self):
+        if self.partitions is None or self.me == self.coordinator:
+            return None
+        return "ERR_WRONGFE:" + self.coordinator
+
+    # getMembership: The epoch-numbered map clients and frontends route by.
+    def getMembership(self):
+        with self.eLock:
+            return {"epoch": self.epoch, "frontends": self.partitions or [],
+                    "servers": sorted(kvsServers.keys()), "replication": self.replication,
+                    "readers": [baseAddr + str(baseServerPort + i) for i in self.published]}
+
+    # readers: Servers that hold every acknowledged put and nothing else, so
+    # clients may read them directly: the tail of the chain, or the primary.
+    # None with fanout (a put may be half applied), partitioned frontends or
+    # a frontend group.
+    def readers(self):
+        if self.partitions is not None or self.raft is not None:
+            return []
+        if self.replication == "chain" and len(activeServers) > 0:
+            return [max(activeServers)]
+        if self.replication == "primary" and self.primary in activeServers:
+            return [self.primary]
+        return []
+
+    # publish_readers: If the readers changed, start a new epoch and push it
+    # to the servers, with a reader lease for the new readers. A reader that
+    # misses the push serves the old epoch only until its lease runs out.
+    # Runs on the publish thread only.
+    def publish_readers(self):
+        readers = self.readers()
+        with self.eLock:
+            if readers == self.published:
+                return
+            self.epoch += 1
+            self.published = readers
+            epoch = self.epoch
+            leases = {i: self.grant(i, self.heartbeat_timeout) for i in list(kvsServers.keys())}
+        for i, lease in leases.items():
+            if i not in self.announces:
+                self.announces[i] = rpc.proxy(baseAddr + str(baseServerPort + i),
+                                              self.heartbeat_timeout)
+            try:
+                self.announces[i].set_epoch(epoch, lease)
+            except:
+                self.announces.pop(i, None)
+
+    # publish_loop: Publish reader changes as soon as republish reports one,
+    # and check for them every heartbeat interval anyway.
+    def publish_loop(self):
+        while True:
+            self.republish.wait(1 / self.heartbeat_rate)
+            self.republish.clear()
+            try:
+                self.publish_readers()
+            except:
+                pass
+
+    # grant: Reader lease to send serverId in a call that takes at most
+    # timeout seconds: reader_lease for a published reader that is still
+    # active, else 0. Records how long the server may hold it. Caller holds
+    # eLock.
+    def grant(self, serverId, timeout):
+        if serverId not in self.published or serverId not in activeServers:
+            return 0
+        self.reader_leases[serverId] = max(self.reader_leases.get(serverId, 0),
+                                           time.monotonic() + timeout + self.reader_lease)
+        return self.reader_lease
+
+    # outlast_readers: Before a put is acknowledged, wait until no server
+    # outside receivers (the servers known to hold the put) can still hold a
+    # reader lease, so direct reads never miss an acknowledged put. A server
+    # leaves activeServers before the put skips it, so any lease granted to
+    # it is recorded by then.
+    def outlast_readers(self, receivers):
+        with self.eLock:
+            until = max([t for i, t in self.reader_leases.items() if i not in receivers] + [0])
+        delay = until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    # set_membership: Adopt the coordinator's server list if its epoch is
+    # newer: copy this frontend's keys to servers that joined, drop servers
+    # that left.
+    def set_membership(self, epoch, servers):
+        with self.wLock:
+            if epoch <= self.epoch:
+                return "Success"
+            for serverId in servers:
+                if serverId not in kvsServers:
+                    self.join(serverId)
+            for serverId in list(kvsServers.keys()):
+                if serverId not in servers:
+                    kvsServers.pop(serverId, None)
+                    serverLocks.pop(serverId, None)
+                    activeServers.discard(serverId)
+                    with self.kLock:
+                        self.hints.pop(serverId, None)
+            self.epoch = epoch
+        return "Success"
+
+    # publish: On the coordinator, start a new epoch and push it to the other
+    # frontends. Caller holds wLock.
+    def publish(self):
+        if self.partitions is None:
+            return
+        self.epoch += 1
+        servers = sorted(kvsServers.keys())
+        for addr in self.partitions:
+            if addr != self.me:
+                try:
+                    rpc.proxy(addr, self.repair_timeout).set_membership(self.epoch, servers)
+                except:
+                    pass
+
+    # take_over: A newly elected leader trusts only the replicated log and
+    # membership. Every server is reconciled against the log by version, which
+    # delivers puts the old leader committed but had not sent everywhere.
+    # Servers that cannot be reconciled are left inactive for repair.
+    def take_over(self, term):
+        with self.kLock:
+            self.assigned = {}
+            self.hints = {}
+            self.read_cache.clear()
+            activeServers.clear()
+            activeServers.update(kvsServers.keys())
+            self.primary = None
+            if self.replication != "primary":
+                for i in sorted(kvsServers.keys()):
+                    try:
+                        if self.log_mode == "values":
+                            self.reconcile(i)
+                        else:
+                            for j in kvsServers.keys():
+                                if j != i:
+                                    self.call(i, "sync_from", j, timeout=self.repair_timeout)
+                    except:
+                        activeServers.discard(i)
+        self.leader_term = term
+
+    def getMetrics(self):
+        with self.mLock:
+            metrics = dict(self.metrics)
+            metrics["servers"] = {str(i): {"ewma_ms": round(self.ewma.get(i, 0) * 1000, 3),
+                                           "outstanding": self.outstanding.get(i, 0)}
+                                  for i in kvsServers.keys()}
+        metrics["cache"] = self.read_cache.stats()
+        metrics["active"] = sorted(activeServers)
+        metrics["primary"] = -1 if self.primary is None else self.primary
+        if self.raft is not None:
+            metrics["raft"] = {"term": self.raft.term, "state": self.raft.state,
+                               "leader": self.raft.leader_addr(), "commit": self.raft.commitIndex}
+        return metrics
+
+    # configure: Change tunables at runtime, e.g. {"read_policy": "p2c"}.
+    def configure(self, options):
+        for name, value in options.items():
+            if name not in ("request_timeout", "rpc_timeout", "read_policy", "ewma_alpha",
+                            "hedge_percentile", "hedge_ratio", "cache_mode", "cache_bytes",
+                            "max_lag", "lease"):
+                return f"ERR_CONFIG {name}"
+            if name == "read_policy" and value not in READ_POLICIES:
+                return f"ERR_CONFIG {name}={value}"
+            if name == "cache_mode" and value not in CACHE_MODES:
+                return f"ERR_CONFIG {name}={value}"
+        for name, value in options.items():
+            if name == "cache_bytes":
+                self.read_cache.capacity = value
+            else:
+                setattr(self, name, value)
+        # Puts skipped the cache while it was off, so never reuse old entries
+        if "cache_mode" in options or "cache_bytes" in options:
+            self.read_cache.clear()
+        return "Success"
+
+    # observe: Fold one call's latency into the server's EWMA.
+    def observe(self, serverId, latency):
+        with self.mLock:
+            prev = self.ewma.get(serverId)
+            self.ewma[serverId] = latency if prev is None else \
+                prev + self.ewma_alpha * (latency - prev)
+
+    # pick_server: Choose the replica to read from. "random" ignores load,
+    # "least" takes the fewest outstanding calls and "p2c" samples two
+    # replicas and keeps the one with the lower EWMA * (outstanding + 1).
+    def pick_server(self, candidates):
+        if self.read_policy == "least" or len(candidates) < 2:
+            fewest = min(self.outstanding.get(i, 0) for i in candidates)
+            return random.choice([i for i in candidates if self.outstanding.get(i, 0) == fewest])
+        if self.read_policy == "p2c":
+            a, b = random.sample(candidates, 2)
+            cost = lambda i: self.ewma.get(i, 0) * (self.outstanding.get(i, 0) + 1)
+            return a if cost(a) <= cost(b) else b
+        return random.choice(candidates)
+
+    # timed_get: get from one replica, recording the latency seen by the
+    # caller (lock wait included) for the hedge threshold.
+    def timed_get(self, serverId, key, deadline):
+        start = time.monotonic()
+        value = self.call(serverId, "get", key, deadline=deadline)
+        with self.mLock:
+            self.read_latencies.append(time.monotonic() - start)
+            self.read_samples += 1
+            # Refresh the threshold every 100 samples rather than sorting per read
+            if self.read_samples >= 20 and \
+                    (self.hedge_delay is None or self.read_samples % 100 == 0):
+                latencies = sorted(self.read_latencies)
+                self.hedge_delay = latencies[int(self.hedge_percentile / 100 * (len(latencies) - 1))]
+        return value
+
+    # can_hedge: Spend a hedge token if one is available.
+    def can_hedge(self):
+        with self.mLock:
+            if self.hedge_tokens < 1:
+                return False
+            self.hedge_tokens -= 1
+            self.metrics["hedges"] += 1
+            return True
+
+    # read: Get key from a replica picked by read_policy. With hedging on, a
+    # second replica is asked once the first is slower than hedge_delay and
+    # whichever answers first wins; the loser is left to finish (or hit the
+    # deadline) on its own.
+    def read(self, key, candidates, deadline):
+        server = self.pick_server(candidates)
+        if self.hedge_percentile <= 0 or len(candidates) < 2:
+            return self.timed_get(server, key, deadline)
+        with self.mLock:
+            self.hedge_tokens = min(self.hedge_tokens + self.hedge_ratio, 10.0)
+        first = self.readPool.submit(self.timed_get, server, key, deadline)
+        if self.hedge_delay is None:
+            return first.result()
+        done, _ = wait([first], timeout=min(self.hedge_delay, deadline.remaining()))
+        if done or not self.can_hedge():
+            return first.result()
+        second = self.readPool.submit(self.timed_get,
+                                      self.pick_server([i for i in candidates if i != server]),
+                                      key, deadline)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self.count("hedge_wins")
+                    return future.result()
+        return first.result()
+
+    # call: Invoke method on a server while holding its lock. The lock wait and
+    # the socket timeout both come out of the remaining deadline so a wedged
+    # server can only hold the caller (and its serverLocks entry) that long.
+    def call(self, serverId, method, *args, deadline=None, timeout=None):
+        timeout = self.rpc_timeout if timeout is None else timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline.remaining())
+        # Raises KeyError for a server removed meanwhile, which is no RPC error
+        lock = serverLocks[serverId]
+        proxy = kvsServers[serverId]
+        with self.mLock:
+            self.outstanding[serverId] = self.outstanding.get(serverId, 0) + 1
+        acquired = timeout > 0 and lock.acquire(timeout=timeout)
+        start = None
+        try:
+            if deadline is not None:
+                timeout = min(timeout, deadline.remaining())
+            if not acquired or timeout <= 0:
+                raise DeadlineExceeded(serverId)
+            rpc.set_timeout(proxy, timeout)
+            start = time.monotonic()
+            return getattr(proxy, method)(*args)
+        except socket.timeout:
+            self.count("rpc_timeouts")
+            raise
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            self.count("rpc_errors")
+            raise
+        finally:
+            if acquired:
+                lock.release()
+            if start is not None:
+                self.observe(serverId, time.monotonic() - start)
+            with self.mLock:
+                self.outstanding[serverId] -= 1
+
+    def expired(self):
+        self.count("deadline_expired")
+        return ERR_DEADLINE
+
+    # pulse: Heartbeat serverId on a proxy of the heartbeat thread's own,
+    # outside serverLocks, so it never waits behind another call. Readers of
+    # the current epoch get their lease renewed.
+    def pulse(self, serverId):
+        if serverId not in self.pulses:
+            self.pulses[serverId] = rpc.proxy(baseAddr + str(baseServerPort + serverId),
+                                              self.heartbeat_timeout)
+        with self.eLock:
+            epoch = self.epoch
+            lease = self.grant(serverId, self.heartbeat_timeout)
+        try:
+            return self.pulses[serverId].heartbeat(epoch, lease)
+        except:
+            # Reconnect next time
+            self.pulses.pop(serverId, None)
+            raise
+
     # Forever heartbeat on thread.
     def start_heartbeat(self):
         self.heartbeat_thread = threading.Thread(target=self.heartbeat_check)
         self.heartbeat_thread.daemon = True
         self.heartbeat_thread.start()
+        self.publish_thread = threading.Thread(target=self.publish_loop)
+        self.publish_thread.daemon = True
+        self.publish_thread.start()
 
     # Ping every server. If alive, reset counter. Otherwise count it dead after some timeout.
     def heartbeat_check(self):
         while True:
+            # Only the leader of a frontend group watches the servers
+            if self.raft is not None:
+                term = self.raft.term
+                if not self.raft.is_leader():
+                    time.sleep(1 / self.heartbeat_rate)
+                    continue
+                if self.leader_term != term:
+                    self.take_over(term)
+            self.prune_leases()
+            if self.coordinate() is not None:
+                try:
+                    membership = rpc.proxy(self.coordinator, self.heartbeat_timeout).getMembership()
+                    self.set_membership(membership["epoch"], membership["servers"])
+                except:
+                    pass
             servers_to_remove = []
             serverList = list(kvsServers.keys())
             heartbeats = {k: 0 for k in serverList}
             for _ in range(self.heartbeat_max + 1):
                 for i in serverList:
+                    # A call in progress holds the server's lock: busy is
+                    # neither a heartbeat nor a miss. Readers are still sent
+                    # one, to renew their lease.
+                    lock = serverLocks.get(i)
+                    busy = lock is None or lock.locked()
+                    if busy and i not in self.published:
+                        continue
                     try:
-                        with serverLocks[i]:
-                            kvsServers[i].heartbeat()
+                        self.pulse(i)
                         heartbeats[i] = 0
                     except:
-                        heartbeats[i] += 1
+                        if not busy:
+                            heartbeats[i] += 1
+                    if heartbeats[i] == 0 and i in kvsServers and i not in activeServers \
+                            and i not in self.joining:
+                        try:
+                            self.repair(i)
+                        except:
+                            pass
                     if heartbeats[i] >= self.heartbeat_max:
                         servers_to_remove.append(i)
                 time.sleep(1 / self.heartbeat_rate)
-            # Remove marked servers
+            # Remove marked servers. Only the coordinator removes servers from
+            # a partitioned membership; the others just stop writing to them.
             for serverId in servers_to_remove:
                 with self.wLock:
-                    kvsServers.pop(serverId, None)
+                    if self.coordinate() is None:
+                        kvsServers.pop(serverId, None)
                     activeServers.discard(serverId)
+                    with self.kLock:
+                        self.hints.pop(serverId, None)
+                if self.raft is not None:
+                    self.raft.propose(["remove", serverId])
+            if len(servers_to_remove) > 0:
+                if self.coordinate() is None:
+                    with self.wLock:
+                        self.publish()
+                self.broadcast_peers()
+            if self.replication == "primary" and self.primary not in activeServers \
+                    and len(activeServers) > 0:
+                try:
+                    self.failover()
+                except:
+                    pass
+            self.republish.set()
             time.sleep(1 / self.heartbeat_rate)
 
+    # repair: Bring a server that missed puts back up to date and reactivate
+    # it, by replaying its hints or else copying the whole log. Runs on the
+    # heartbeat thread so that client puts are never charged for it.
+    def repair(self, serverId):
+        with self.kLock:
+            hinted = serverId in self.hints
+        if hinted:
+            return self.replay_hints(serverId)
+        with self.kLock:
+            self.quiesce()
+            self.copy_log(serverId)
+            self.hints.pop(serverId, None)
+            self.reactivate(serverId)
+        self.count("full_repairs")
+
+    # reactivate: Write to serverId again once it is repaired. A primary that
+    # dropped it as a lagging backup is told to ship to it again. Caller
+    # holds kLock.
+    def reactivate(self, serverId):
+        activeServers.add(serverId)
+        if self.replication == "primary" and self.primary is not None and self.primary != serverId:
+            try:
+                self.call(self.primary, "resume", [serverId], timeout=self.heartbeat_timeout)
+            except:
+                pass
+
+    # failover: Promote the backup that has applied the most of the old
+    # primary's operation log, then bring it and the other backups up to
+    # date: from the master log by comparing versions, or in metadata mode by
+    # syncing with each other. Puts the old primary acked but never shipped
+    # are lost in metadata mode.
+    def failover(self):
+        with self.kLock:
+            self.quiesce()
+            seqs = {}
+            for i in sorted(activeServers):
+                try:
+                    seqs[i] = self.call(i, "get_seq", timeout=self.heartbeat_timeout)
+                except:
+                    activeServers.discard(i)
+                    self.hints.pop(i, None)
+            if len(seqs) == 0:
+                return
+            primary = max(seqs, key=lambda i: seqs[i])
+            backups = [i for i in seqs if i != primary]
+            if self.log_mode == "values":
+                for i in [primary] + backups:
+                    self.reconcile(i)
+            else:
+                for i in backups:
+                    self.call(primary, "sync_from", i, timeout=self.repair_timeout)
+                for i in backups:
+                    self.call(i, "sync_from", primary, timeout=self.repair_timeout)
+            self.primary = primary
+        self.count("failovers")
+
+    # reconcile: Send serverId every key whose log version is newer than its
+    # own. Caller holds kLock.
+    def reconcile(self, serverId):
+        versions = self.call(serverId, "get_versions", timeout=self.repair_timeout)
+        stale = [k for k, (version, _) in self.log.items() if version > versions.get(k, 0)]
+        self.send_keys(serverId, stale)
+
+    # up_to_date: Servers that serverId can copy values from in metadata
+    # mode. Only the primary has every put while backups lag behind.
+    def up_to_date(self, serverId):
+        if self.replication == "primary":
+            return [i for i in [self.primary] if i in activeServers and i != serverId]
+        return [i for i in activeServers if i != serverId]
+
+    # add_hint: Remember that serverId missed the put of key. Caller holds
+    # kLock. Only servers that were up to date when they went inactive keep
+    # hints, since a partial set would be wrong for anyone else.
+    def add_hint(self, serverId, key, create=False):
+        if serverId not in self.hints:
+            if not create:
+                return
+            self.hints[serverId] = set()
+        self.hints[serverId].add(key)
+        if len(self.hints[serverId]) > self.hint_limit:
+            del self.hints[serverId]
+        self.count("hints_recorded")
+
+    # replay_hints: Resend the hinted keys (from the log, or from a peer in
+    # metadata mode) until a pass finds no new hints, then reactivate. Puts
+    # record hints under kLock, so once the set is empty under kLock every
+    # missed write has been delivered. Keys whose version did not land (a
+    # peer that has not seen an in-flight put yet) go back into the hints.
+    def replay_hints(self, serverId):
+        while True:
+            with self.kLock:
+                if serverId not in self.hints:
+                    return
+                keys = list(self.hints[serverId])
+                if len(keys) == 0:
+                    del self.hints[serverId]
+                    self.reactivate(serverId)
+                    return
+                self.hints[serverId] = set()
+            try:
+                self.send_keys(serverId, keys)
+                landed = self.call(serverId, "get_versions", keys, timeout=self.repair_timeout)
+            except:
+                with self.kLock:
+                    if serverId in self.hints:
+                        self.hints[serverId].update(keys)
+                raise
+            missing = [k for k in keys if landed.get(k, 0) < self.log[k][0]]
+            self.count("hints_replayed", len(keys) - len(missing))
+            if len(missing) > 0:
+                with self.kLock:
+                    for k in missing:
+                        self.add_hint(serverId, k)
+                time.sleep(1 / self.heartbeat_rate)
+
+    # send_keys: Deliver the current version of each key to serverId.
+    def send_keys(self, serverId, keys):
+        for start in range(0, len(keys), self.repair_batch):
+            batch = keys[start:start + self.repair_batch]
+            if self.log_mode == "values":
+                data, versions = {}, {}
+                for k in batch:
+                    versions[k], data[k] = self.log[k]
+                self.call(serverId, "put_many", data, versions, timeout=self.repair_timeout)
+            else:
+                peers = self.up_to_date(serverId)
+                if len(peers) == 0:
+                    raise Exception(f"no up-to-date peer to replay hints for server {serverId}")
+                self.call(serverId, "sync_from", self.pick_server(peers), batch,
+                          timeout=self.repair_timeout)
+
+    # quiesce: Wait for in-flight puts to finish their fan-out. Caller holds
+    # kLock, which keeps new puts from starting meanwhile.
+    def quiesce(self):
+        if not self.idle.wait_for(lambda: self.inflight == 0, self.repair_timeout):
+            raise DeadlineExceeded("quiesce")
+
+    # copy_log: Bring serverId up to date, from the master log or, in
+    # metadata mode, from an active server. Caller holds kLock.
+    def copy_log(self, serverId):
+        if self.log_mode == "values":
+            return self.transfer(serverId)
+        peers = self.up_to_date(serverId)
+        if len(peers) == 0:
+            if len(self.log) == 0:
+                return
+            raise Exception(f"no up-to-date peer to repair server {serverId} from")
+        self.call(serverId, "sync_from", self.pick_server(peers), timeout=self.repair_timeout)
+
+    # transfer: Replace a server's data with the master log, streamed in
+    # batches so that a spilled log is never loaded into memory at once. The
+    # batches are staged on the server and swapped in together, so readers
+    # never see it half copied. Caller holds kLock.
+    def transfer(self, serverId):
+        # A partitioned frontend holds only some keys: never wipe the others
+        partial = self.partitions is not None
+        first = True
+        batch = {}
+        versions = {}
+        for k, (version, value) in self.log.items():
+            batch[k] = value
+            versions[k] = version
+            if len(batch) >= self.repair_batch:
+                args = ("put_many", batch, versions) if partial else ("stage", batch, versions, first)
+                self.call(serverId, *args, timeout=self.repair_timeout)
+                first = False
+                batch = {}
+                versions = {}
+        if partial:
+            if len(batch) > 0:
+                self.call(serverId, "put_many", batch, versions, timeout=self.repair_timeout)
+            return
+        self.call(serverId, "stage", batch, versions, first, timeout=self.repair_timeout)
+        self.call(serverId, "swap", timeout=self.repair_timeout)
+
+    # log_put: Give the put the key's next version and sequence number, write
+    # it to the master log and count it in flight. Returns the version, the
+    # sequence number and the servers to send it to; inactive servers get a
+    # hint instead. In a frontend group the log is written when the Raft
+    # entry is applied, and None means it was not committed in time.
+    def log_put(self, key, value, deadline):
+        with self.kLock:
+            self.seq += 1
+            seq = self.seq
+            entry = self.log.get(key)
+            version = max(0 if entry is None else entry[0], self.assigned.get(key, 0)) + 1
+            if self.raft is None:
+                self.log[key] = (version, value if self.log_mode == "values" else None)
+            else:
+                self.assigned[key] = version
+            self.inflight += 1
+            # Servers that are not active miss this put: leave them a hint
+            activeServersList = list(activeServers)
+            for i in kvsServers.keys():
+                if i not in activeServers:
+                    self.add_hint(i, key)
+        command = ["put", key, version, seq] + ([value] if self.log_mode == "values" else [])
+        if not self.commit(command, deadline):
+            with self.kLock:
+                self.inflight -= 1
+                self.idle.notify_all()
+            return None
+        return version, seq, activeServersList
+
     # put: This function routes requests from clients to proper
     # servers that are responsible for inserting a new key-value
     # pair or updating an existing one.
     # Per key versioning
-    def put(self, key, value):
+    def put(self, key, value, budget=None):
+        deadline = Deadline(self.request_timeout if budget is None else budget)
+        error = self.lead(deadline) or self.owner(str(key))
+        if error is not None:
+            return error
         if len(kvsServers) == 0:
             return "ERR_NOSERVERS"
-        # Create lock per key
+        # Create lock per key, then wait for it outside kLock
+        key = str(key)
+        if self.replication == "chain":
+            return self.chain_put(key, value, deadline)
+        if self.replication == "primary":
+            return self.primary_put(key, value, deadline)
         with self.kLock:
-            key = str(key)            
             if key not in self.key_to_lock:
                 self.key_to_lock[key] = threading.Lock()
-                self.key_to_lock[key].acquire()
-            else:
-                self.key_to_lock[key].acquire()
-            self.log[key] = value
-        # Try and put for all active servers, otherwise deprecate it
-        activeServersList = list(activeServers)
-        for i in activeServersList:
+            keyLock = self.key_to_lock[key]
+        if not keyLock.acquire(timeout=deadline.remaining()):
+            return self.expired()
+        try:
+            # The budget only decides whether the put starts. Once it is in
+            # the log it goes to every server under rpc_timeout, so a server
+            # is never taken for failed because the client ran out of time.
+            if deadline.expired():
+                return self.expired()
+            logged = self.log_put(key, value, deadline)
+            if logged is None:
+                return self.lead(deadline) or self.expired()
+            version, _, activeServersList = logged
             try:
-                with serverLocks[i]:
-                    kvsServers[i].put(key, value)
-            except:
+                if self.cache_mode == "serve":
+                    self.read_cache.put(key, value)
+                # Try and put for all active servers, otherwise deprecate it
+                # and hand the write off to the hint store
+                for i in activeServersList:
+                    try:
+                        self.call(i, "put", key, value, version)
+                    except:
+                        with self.kLock:
+                            activeServers.discard(i)
+                            self.add_hint(i, key, create=True)
+                self.revoke_leases(key)
+            finally:
                 with self.kLock:
-                    activeServers.discard(i)
-        # Try and repair ones that were missed from previous puts and reactive them
-        activeServersList = list(activeServers)
-        serverIds = set(kvsServers.keys())
-        repairServers = [i for i in serverIds if i not in activeServersList]
-        for i in repairServers:
+                    self.inflight -= 1
+                    self.idle.notify_all()
+            return rpc.stored(key, value)
+        finally:
+            keyLock.release()
+
+
+    # chain_put: Chain replication. The put goes to the head of the chain
+    # (active servers in id order), each server applies it and passes it on,
+    # and the tail's reply is the acknowledgement. No key lock is taken: the
+    # versions handed out by log_put order concurrent puts of a key on every
+    # server. As in put, the budget only decides whether the put starts;
+    # each link then gets rpc_timeout. A broken link is dropped from the
+    # chain (with a hint) and the put is resent down the shorter chain.
+    def chain_put(self, key, value, deadline):
+        if deadline.expired():
+            return self.expired()
+        logged = self.log_put(key, value, deadline)
+        if logged is None:
+            return self.lead(deadline) or self.expired()
+        version, _, chain = logged
+        try:
+            chain.sort()
+            while len(chain) > 0:
+                failed = chain[0]
+                try:
+                    result = self.chain_call(chain[0], key, value, version, chain[1:])
+                    if result == "Success":
+                        break
+                    failed = int(result.split(':')[1])
+                except:
+                    pass
+                with self.kLock:
+                    activeServers.discard(failed)
+                    self.add_hint(failed, key, create=True)
+                self.republish.set()
+                chain = [i for i in chain if i != failed]
+            if self.cache_mode == "serve":
+                self.read_cache.discard(key)
+            self.revoke_leases(key)
+            self.outlast_readers(chain)
+            return rpc.stored(key, value)
+        finally:
+            with self.kLock:
+                self.inflight -= 1
+                self.idle.notify_all()
+
+    # chain_call: chain_put to the head of the chain on a proxy of its own,
+    # allowing rpc_timeout for each link. Proxies that fail are not reused.
+    def chain_call(self, head, key, value, version, rest):
+        with self.cLock:
+            idle = self.chain_proxies.setdefault(head, [])
+            proxy = idle.pop() if len(idle) > 0 else rpc.proxy(baseAddr + str(baseServerPort + head))
+        rpc.set_timeout(proxy, self.rpc_timeout * (len(rest) + 1))
+        start = time.monotonic()
+        try:
+            result = proxy.chain_put(key, value, version, rest, self.rpc_timeout)
+        except socket.timeout:
+            self.count("rpc_timeouts")
+            raise
+        except Exception:
+            self.count("rpc_errors")
+            raise
+        self.observe(head, time.monotonic() - start)
+        with self.cLock:
+            self.chain_proxies[head].append(proxy)
+        return result
+
+    # primary_put: Primary-backup. Only the primary is written and acks the
+    # put, within a single server round trip; it ships its operation log to
+    # the backups in the background. As in put, the budget only decides
+    # whether the put starts: the primary gets it under rpc_timeout. A
+    # primary that fails the call is marked inactive and the put waits for
+    # the heartbeat thread to promote a backup, but one whose lock stays busy
+    # is only slow. Backups the primary reports as LAGGING (shipping failed,
+    # or more than max_lag puts behind) are marked inactive and fully
+    # repaired, since their missed puts are unknown.
+    def primary_put(self, key, value, deadline):
+        while not deadline.expired():
+            primary = self.primary
+            if primary is None or primary not in activeServers:
+                time.sleep(.01)
+                continue
+            logged = self.log_put(key, value, deadline)
+            if logged is None:
+                return self.lead(deadline) or self.expired()
+            version, seq, servers = logged
             try:
+                if primary not in servers:
+                    continue
+                backups = [i for i in servers if i != primary]
+                try:
+                    result = self.call(primary, "primary_put", key, value, version, seq, backups,
+                                       self.max_lag, self.rpc_timeout)
+                except DeadlineExceeded:
+                    return self.expired()
+                except:
+                    with self.kLock:
+                        activeServers.discard(primary)
+                        self.hints.pop(primary, None)
+                        if self.primary == primary:
+                            self.primary = None
+                    self.republish.set()
+                    continue
+                if result.startswith("LAGGING:"):
+                    with self.kLock:
+                        for i in result.split(':')[1].split(','):
+                            activeServers.discard(int(i))
+                            self.hints.pop(int(i), None)
+                if self.cache_mode == "serve":
+                    self.read_cache.discard(key)
+                self.revoke_leases(key)
+                self.outlast_readers([primary])
+                return rpc.stored(key, value)
+            finally:
                 with self.kLock:
-                    with serverLocks[i]:
-                        kvsServers[i].update_data({k: v for k, v in self.log.items()})
-                    activeServers.add(i)
+                    self.inflight -= 1
+                    self.idle.notify_all()
+        return self.expired()
+
+    # primary_get: Primary-backup reads go to the primary, the only server
+    # guaranteed to hold every acked put. Running out of budget, waiting for
+    # the primary or on the socket, says nothing about the primary's health.
+    def primary_get(self, key, deadline):
+        while not deadline.expired():
+            primary = self.primary
+            if primary is None or primary not in activeServers:
+                time.sleep(.01)
+                continue
+            try:
+                value = self.call(primary, "get", key, deadline=deadline)
+                if value == "ERR_KEY":
+                    return "ERR_KEY"
+                return rpc.found(key, value)
+            except DeadlineExceeded:
+                break
             except:
-                pass
-        self.key_to_lock[key].release()
-        return f"Success put {key}:{value}"
+                if deadline.expired():
+                    break
+                with self.kLock:
+                    activeServers.discard(primary)
+                    self.hints.pop(primary, None)
+                    if self.primary == primary:
+                        self.primary = None
+                self.republish.set()
+        return self.expired()
 
+    # chain_get: Chain replication reads go to the tail, which only holds
+    # writes that every server in the chain has applied, so no key lock is
+    # needed. A tail that fails is dropped and its predecessor takes over.
+    def chain_get(self, key, deadline):
+        while not deadline.expired():
+            chain = sorted(activeServers)
+            if len(chain) == 0:
+                if len(kvsServers) == 0:
+                    return "ERR_NOSERVERS"
+                time.sleep(.01)
+                continue
+            try:
+                value = self.call(chain[-1], "get", key, deadline=deadline)
+                # First put of the key has not reached the tail yet
+                if value == "ERR_KEY":
+                    return "ERR_KEY"
+                return rpc.found(key, value)
+            except DeadlineExceeded:
+                break
+            except:
+                if deadline.expired():
+                    break
+                with self.kLock:
+                    if chain[-1] in activeServers:
+                        activeServers.discard(chain[-1])
+                        self.hints.setdefault(chain[-1], set())
+                self.republish.set()
+        return self.expired()
 
     # get: This function routes requests from clients to proper
     # servers that are responsible for getting the value
     # associated with the given key.
-    def get(self, key):
+    def get(self, key, budget=None):
+        deadline = Deadline(self.request_timeout if budget is None else budget)
         key = str(key)
+        error = self.lead(deadline, lease=True) or self.owner(key)
+        if error is not None:
+            return error
         if key not in self.log:
             return "ERR_KEY"
         if len(kvsServers) == 0:
             return "ERR_NOSERVERS" 
-        # Could potentially have concurrent get/put, put will create the lock
-        while key not in self.key_to_lock:
-            time.sleep(.00001)
-        # Operations are atomic for get/put on same key
-        with self.key_to_lock[key]:
+        if self.replication == "chain":
+            return self.chain_get(key, deadline)
+        if self.replication == "primary":
+            return self.primary_get(key, deadline)
+        # Operations are atomic for get/put on same key. A log recovered from
+        # disk has keys that no put has created a lock for yet.
+        with self.kLock:
+            if key not in self.key_to_lock:
+                self.key_to_lock[key] = threading.Lock()
+            keyLock = self.key_to_lock[key]
+        if not keyLock.acquire(timeout=deadline.remaining()):
+            return self.expired()
+        try:
+            if self.cache_mode == "serve":
+                hit, value = self.read_cache.get(key)
+                if hit:
+                    return rpc.found(key, value)
             serverIds = list(kvsServers.keys())
             activeServersList = list(activeServers)
             # Get with retries, while there are still servers that could be alive
             while len(serverIds) != 0:
-                # Get from random active server
+                if deadline.expired():
+                    return self.expired()
+                # Get from an active server chosen by read_policy
                 if len(activeServersList) > 0:
-                    server = random.choice(activeServersList)
                     try:
-                        with serverLocks[server]:
-                            value = kvsServers[server].get(key)
-                            return f"{key}:{value}"
+                        value = self.read(key, activeServersList, deadline)
+                        if self.cache_mode == "serve":
+                            self.read_cache.put(key, value)
+                        return rpc.found(key, value)
                     except Exception:
                         pass
                 serverIds = list(kvsServers.keys())
                 activeServersList = list(activeServers)
                 time.sleep(.01)
             return "ERR_NOSERVERS"
+        finally:
+            keyLock.release()
+
+    # lease_get: get that also grants the holder (a client address) a lease
+    # on the key. Returns [result, lease seconds]. The lease is recorded
+    # before the read so that a put racing with it always revokes it.
+    # Redirects (ERR_NOTLEADER, ERR_WRONGFE) are returned as they are, for
+    # the client to follow.
+    def lease_get(self, key, holder, budget=None):
+        deadline = Deadline(self.request_timeout if budget is None else budget)
+        key = str(key)
+        error = self.lead(deadline, lease=True) or self.owner(key)
+        if error is not None:
+            return error
+        granted = self.lease
+        if granted > 0:
+            expiry = time.monotonic() + granted
+            with self.kLock:
+                self.leases.setdefault(key, {})[holder] = expiry
+        result = self.get(key, deadline.remaining())
+        failed = not rpc.is_binary(result) and not result.startswith(key + ":")
+        if granted > 0 and failed:
+            self.forget_lease(key, holder, expiry)
+        if not rpc.is_binary(result) and result.startswith(("ERR_NOTLEADER:", "ERR_WRONGFE:")):
+            return result
+        if failed:
+            granted = 0
+        elif granted > 0:
+            self.count("leases_granted")
+        return [result, granted]
+
+    # revoke_leases: Before a put of key is acknowledged, stop clients from
+    # serving the old value from their near caches: revoke every unexpired
+    # lease, and wait out those whose holder cannot be reached. The put has
+    # been applied by now, so this is not cut short by the request budget.
+    # A holder is forgotten only once it is revoked or its lease has run out.
+    def revoke_leases(self, key):
+        with self.kLock:
+            holders = dict(self.leases.get(key, {}))
+        if len(holders) == 0:
+            return
+        unreachable = {}
+        for holder, expiry in holders.items():
+            if expiry > time.monotonic():
+                try:
+                    rpc.proxy(holder, self.revoke_timeout).revoke(key)
+                    self.count("leases_revoked")
+                except:
+                    unreachable[holder] = expiry
+                    continue
+            self.forget_lease(key, holder, expiry)
+        if len(unreachable) > 0:
+            self.count("lease_waits")
+            time.sleep(max(0.0, max(unreachable.values()) - time.monotonic()))
+            for holder, expiry in unreachable.items():
+                self.forget_lease(key, holder, expiry)
+
+    # forget_lease: Drop holder's lease on key, unless a lease_get renewed it
+    # meanwhile (that read saw the put, so the new lease is still valid).
+    def forget_lease(self, key, holder, expiry):
+        with self.kLock:
+            holders = self.leases.get(key)
+            if holders is None or holders.get(holder) != expiry:
+                return
+            del holders[holder]
+            if len(holders) == 0:
+                del self.leases[key]
+
+    # prune_leases: Forget every expired lease, at most every lease_prune
+    # seconds, so keys that are only read do not hold on to their holders.
+    def prune_leases(self):
+        now = time.monotonic()
+        if now - self.pruned < self.lease_prune:
+            return
+        self.pruned = now
+        with self.kLock:
+            for key in list(self.leases.keys()):
+                holders = self.leases[key]
+                for holder in [h for h, expiry in holders.items() if expiry <= now]:
+                    del holders[holder]
+                if len(holders) == 0:
+                    del self.leases[key]
+
+    # put_many: Batched put of a key -> value dict. Returns key -> the result
+    # put would give. With fanout the keys are locked in order and each server
+    # gets one put_many for the whole batch; other modes put key by key.
+    def put_many(self, data, budget=None):
+        deadline = Deadline(self.request_timeout if budget is None else budget)
+        error = self.lead(deadline)
+        results = {}
+        batch = {}
+        for key, value in data.items():
+            key = str(key)
+            results[key] = error or self.owner(key)
+            if results[key] is None:
+                batch[key] = value
+        if len(batch) == 0:
+            return results
+        if len(kvsServers) == 0:
+            results.update({key: "ERR_NOSERVERS" for key in batch})
+            return results
+        if self.replication != "fanout":
+            for key, value in batch.items():
+                results[key] = self.put(key, value, deadline.remaining())
+            return results
+        with self.kLock:
+            for key in batch:
+                if key not in self.key_to_lock:
+                    self.key_to_lock[key] = threading.Lock()
+            keyLocks = [self.key_to_lock[key] for key in sorted(batch)]
+        acquired = []
+        try:
+            for keyLock in keyLocks:
+                if not keyLock.acquire(timeout=deadline.remaining()):
+                    results.update({key: self.expired() for key in batch})
+                    return results
+                acquired.append(keyLock)
+            # As in put, the budget only decides whether the batch starts
+            if deadline.expired():
+                results.update({key: self.expired() for key in batch})
+                return results
+            versions = {}
+            servers = []
+            for key, value in batch.items():
+                logged = self.log_put(key, value, deadline)
+                if logged is None:
+                    results[key] = self.lead(deadline) or self.expired()
+                    continue
+                versions[key], _, servers = logged
+            written = {key: batch[key] for key in versions}
+            try:
+                if self.cache_mode == "serve":
+                    for key, value in written.items():
+                        self.read_cache.put(key, value)
+                for i in servers:
+                    try:
+                        self.call(i, "put_many", written, versions)
+                    except:
+                        with self.kLock:
+                            activeServers.discard(i)
+                            for key in written:
+                                self.add_hint(i, key, create=True)
+                for key in written:
+                    self.revoke_leases(key)
+            finally:
+                with self.kLock:
+                    self.inflight -= len(written)
+                    self.idle.notify_all()
+            for key, value in written.items():
+                results[key] = rpc.stored(key, value)
+            return results
+        finally:
+            for keyLock in acquired:
+                keyLock.release()
+
+    # bulk_load: Preload a key -> value dict before a run. The whole batch
+    # gets its versions and goes into the master log under one kLock (one
+    # write for a spilled log, one Raft entry in a frontend group), then is
+    # sent in key order to every active server at once with put_many,
+    # whatever the replication mode. The key locks are taken in key order,
+    # as put_many does, so a get cannot cache a value the load replaces.
+    # Returns key -> error for the keys that were not loaded (an empty dict
+    # if all were).
+    def bulk_load(self, data, budget=None):
+        deadline = Deadline(self.repair_timeout if budget is None else budget)
+        error = self.lead(deadline)
+        rejected = {}
+        batch = {}
+        for key, value in data.items():
+            key = str(key)
+            result = error or self.owner(key)
+            if result is None:
+                batch[key] = value
+            else:
+                rejected[key] = result
+        if len(batch) == 0:
+            return rejected
+        if len(kvsServers) == 0:
+            rejected.update({key: "ERR_NOSERVERS" for key in batch})
+            return rejected
+        keys = sorted(batch)
+        with self.kLock:
+            for key in keys:
+                if key not in self.key_to_lock:
+                    self.key_to_lock[key] = threading.Lock()
+            keyLocks = [self.key_to_lock[key] for key in keys]
+        acquired = []
+        try:
+            for keyLock in keyLocks:
+                if not keyLock.acquire(timeout=deadline.remaining()):
+                    rejected.update({key: self.expired() for key in keys})
+                    return rejected
+                acquired.append(keyLock)
+            with self.kLock:
+                self.seq += 1
+                seq = self.seq
+                versions = {}
+                entries = {}
+                for key in keys:
+                    entry = self.log.get(key)
+                    versions[key] = max(0 if entry is None else entry[0], self.assigned.get(key, 0)) + 1
+                    entries[key] = (versions[key], batch[key] if self.log_mode == "values" else None)
+                if self.raft is None:
+                    self.log.update(entries)
+                else:
+                    self.assigned.update(versions)
+                self.inflight += len(keys)
+                servers = list(activeServers)
+                for i in kvsServers.keys():
+                    if i not in activeServers:
+                        for key in keys:
+                            self.add_hint(i, key)
+            try:
+                command = ["load", [[key, versions[key]] + ([batch[key]] if self.log_mode == "values" else [])
+                                    for key in keys], seq]
+                if not self.commit(command, deadline):
+                    error = self.lead(deadline) or self.expired()
+                    rejected.update({key: error for key in keys})
+                    return rejected
+                with ThreadPoolExecutor(max_workers=max(1, len(servers))) as pool:
+                    sends = {i: pool.submit(self.send_sorted, i, keys, batch, versions, deadline)
+                             for i in servers}
+                if self.cache_mode == "serve":
+                    for key in keys:
+                        self.read_cache.discard(key)
+                for i, send in sends.items():
+                    if send.exception() is not None:
+                        with self.kLock:
+                            activeServers.discard(i)
+                            for key in keys:
+                                self.add_hint(i, key, create=True)
+                for key in keys:
+                    if key in self.leases:
+                        self.revoke_leases(key)
+            finally:
+                with self.kLock:
+                    self.inflight -= len(keys)
+                    self.idle.notify_all()
+            if deadline.expired():
+                rejected.update({key: self.expired() for key in keys})
+            return rejected
+        finally:
+            for keyLock in acquired:
+                keyLock.release()
+
+    # send_sorted: put_many the keys, in order, to serverId in chunks of
+    # bulk_batch.
+    def send_sorted(self, serverId, keys, data, versions, deadline):
+        for start in range(0, len(keys), self.bulk_batch):
+            chunk = keys[start:start + self.bulk_batch]
+            self.call(serverId, "put_many", {key: data[key] for key in chunk},
+                      {key: versions[key] for key in chunk}, deadline=deadline,
+                      timeout=self.repair_timeout)
+
+    # get_many: Batched get of a list of keys. Returns key -> the result get
+    # would give. With fanout the keys are locked in order and read from one
+    # server in a single call; other modes get key by key.
+    def get_many(self, keys, budget=None):
+        deadline = Deadline(self.request_timeout if budget is None else budget)
+        error = self.lead(deadline, lease=True)
+        results = {}
+        batch = []
+        for key in keys:
+            key = str(key)
+            results[key] = error or self.owner(key)
+            if results[key] is None:
+                if key not in self.log:
+                    results[key] = "ERR_KEY"
+                else:
+                    batch.append(key)
+        if len(batch) == 0:
+            return results
+        if self.replication != "fanout" or len(kvsServers) == 0:
+            for key in batch:
+                results[key] = self.get(key, deadline.remaining())
+            return results
+        with self.kLock:
+            for key in batch:
+                if key not in self.key_to_lock:
+                    self.key_to_lock[key] = threading.Lock()
+            keyLocks = [self.key_to_lock[key] for key in sorted(set(batch))]
+        acquired = []
+        try:
+            for keyLock in keyLocks:
+                if not keyLock.acquire(timeout=deadline.remaining()):
+                    results.update({key: self.expired() for key in batch})
+                    return results
+                acquired.append(keyLock)
+            if self.cache_mode == "serve":
+                missing = []
+                for key in batch:
+                    hit, value = self.read_cache.get(key)
+                    if hit:
+                        results[key] = rpc.found(key, value)
+                    else:
+                        missing.append(key)
+                batch = missing
+            while len(batch) > 0:
+                if deadline.expired():
+                    results.update({key: self.expired() for key in batch})
+                    break
+                activeServersList = list(activeServers)
+                if len(activeServersList) == 0:
+                    if len(kvsServers) == 0:
+                        results.update({key: "ERR_NOSERVERS" for key in batch})
+                        break
+                    time.sleep(.01)
+                    continue
+                try:
+                    values = self.call(self.pick_server(activeServersList), "get_many", batch,
+                                       deadline=deadline)
+                except Exception:
+                    time.sleep(.01)
+                    continue
+                for key in batch:
+                    if key in values:
+                        results[key] = rpc.found(key, values[key])
+                        if self.cache_mode == "serve":
+                            self.read_cache.put(key, values[key])
+                    else:
+                        results[key] = "ERR_KEY"
+                break
+            return results
+        finally:
+            for keyLock in acquired:
+                keyLock.release()
 
     # printKVPairs: This function routes requests to servers
     # matched with the given serverIds.
@@ -146,22 +1489,50 @@ class FrontendRPCServer:
         if serverId not in kvsServers:
             return "ERR_NOEXIST"
         print(f"printKVPairs {serverId}")
-        with serverLocks[serverId]:
-            return kvsServers[serverId].printKVPairs()
+        return self.call(serverId, "printKVPairs", timeout=self.repair_timeout)
 
     # addServer: This function registers a new server with the
     # serverId to the cluster membership.
     def addServer(self, serverId):
+        error = self.lead(Deadline(self.repair_timeout)) or self.coordinate()
+        if error is not None:
+            return error
         with self.wLock:
-            kvsServers[serverId] = xmlrpc.client.ServerProxy(
-                baseAddr + str(baseServerPort + serverId))
+            self.join(serverId)
+            if not self.commit(["add", serverId], Deadline(self.repair_timeout)):
+                return self.lead(Deadline(0)) or self.expired()
+            self.publish()
+        self.broadcast_peers()
+        self.republish.set()
+        return "Success"
+
+    # join: Populate a new server with the master log and start writing to
+    # it. Caller holds wLock.
+    def join(self, serverId):
+        self.joining.add(serverId)
+        try:
+            kvsServers[serverId] = rpc.proxy(
+                baseAddr + str(baseServerPort + serverId), self.rpc_timeout)
             serverLocks[serverId] = threading.Lock()
             # Adding a server and populate with master log
             with self.kLock:
-                with serverLocks[serverId]:
-                    kvsServers[serverId].update_data({k: v for k, v in self.log.items()})
+                self.quiesce()
+                self.copy_log(serverId)
                 activeServers.add(serverId)
-                return "Success"
+                if self.replication == "primary" and self.primary is None:
+                    self.primary = serverId
+        finally:
+            self.joining.discard(serverId)
+
+    # broadcast_peers: Tell every server the current membership so they can
+    # run anti-entropy among themselves.
+    def broadcast_peers(self):
+        serverList = list(kvsServers.keys())
+        for i in serverList:
+            try:
+                self.call(i, "set_peers", serverList)
+            except:
+                pass
 
     def listServer(self):
         serverList = list(kvsServers.keys())
@@ -176,20 +1547,97 @@ class FrontendRPCServer:
     # a server matched with the specified serverId to let the corresponding
     # server terminate normally.
     def shutdownServer(self, serverId):
+        error = self.lead(Deadline(self.repair_timeout)) or self.coordinate()
+        if error is not None:
+            return error
         with self.wLock:
             if serverId not in kvsServers.keys():
                 return "ERR_NOEXIST"
             try:
-                with serverLocks[serverId]:
-                    kvsServers[serverId].shutdownServer()
+                self.call(serverId, "shutdownServer")
                 kvsServers.pop(serverId, None)
                 serverLocks.pop(serverId, None)
                 activeServers.discard(serverId)
-                return f"[Shutdown Server {serverId}]"
+                with self.kLock:
+                    self.hints.pop(serverId, None)
             except:
                 return f"[ERROR SHUTTING DOWN SERVER {serverId}]"
+            self.commit(["remove", serverId], Deadline(self.repair_timeout))
+            self.publish()
+        self.broadcast_peers()
+        self.republish.set()
+        return f"[Shutdown Server {serverId}]"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''To be added.''')
+
+    parser.add_argument('-t', '--timeout', nargs=1, type=float, metavar='T',
+                        help='Default request budget in seconds', dest='timeout', default=[5.0])
+    parser.add_argument('--rpc-timeout', nargs=1, type=float, metavar='T',
+                        help='Timeout of a single server RPC in seconds', dest='rpcTimeout', default=[1.0])
+    parser.add_argument('--read-policy', nargs=1, type=str, choices=READ_POLICIES,
+                        help='Replica selection for get', dest='readPolicy', default=["random"])
+    parser.add_argument('--hedge-percentile', nargs=1, type=float, metavar='P',
+                        help='Hedge gets slower than this percentile of recent gets (0 disables)',
+                        dest='hedgePercentile', default=[0])
+    parser.add_argument('--hedge-ratio', nargs=1, type=float, metavar='R',
+                        help='Maximum fraction of gets that may be hedged', dest='hedgeRatio', default=[0.05])
+    parser.add_argument('--cache-mode', nargs=1, type=str, choices=CACHE_MODES,
+                        help='Serve cached reads without a server ("serve") or not ("off")',
+                        dest='cacheMode', default=["off"])
+    parser.add_argument('--cache-bytes', nargs=1, type=int, metavar='B',
+                        help='Read cache capacity in bytes', dest='cacheBytes', default=[64 * 1024 * 1024])
+    parser.add_argument('--log-dir', nargs=1, type=str, metavar='D',
+                        help='Keep the master log on disk in this directory', dest='logDir', default=[None])
+    parser.add_argument('--log-mode', nargs=1, type=str, choices=LOG_MODES,
+                        help='Keep values in the master log, or versions only and repair from peers',
+                        dest='logMode', default=["values"])
+    parser.add_argument('--replication', nargs=1, type=str, choices=REPLICATION_MODES,
+                        help='Write to every server from the frontend, down a chain of servers, or to a primary',
+                        dest='replication', default=["fanout"])
+    parser.add_argument('--max-lag', nargs=1, type=int, metavar='N',
+                        help='Puts a primary may run ahead of its backups before it waits for them',
+                        dest='maxLag', default=[1000])
+    parser.add_argument('-i', '--id', nargs=1, type=int, metavar='I',
+                        help='Frontend id, served on port 8001 + id', dest='frontendId', default=[0])
+    parser.add_argument('--peers', nargs=1, type=str, metavar='IDS',
+                        help='Comma-separated ids of a Raft-replicated frontend group, e.g. 0,1,2',
+                        dest='peers', default=[None])
+    parser.add_argument('--raft-dir', nargs=1, type=str, metavar='D',
+                        help='Persist the Raft log and vote in this directory', dest='raftDir', default=[None])
+    parser.add_argument('--lease', nargs=1, type=float, metavar='S',
+                        help='Lease in seconds granted to client near caches (0 disables)',
+                        dest='lease', default=[0])
+    parser.add_argument('--frontends', nargs=1, type=str, metavar='IDS',
+                        help='Comma-separated ids of frontends that partition the keys, e.g. 0,1,2 '
+                             '(the first one coordinates membership)',
+                        dest='frontends', default=[None])
 
+    args = parser.parse_args()
 
-server = SimpleThreadedXMLRPCServer(("localhost", 8001))
-server.register_instance(FrontendRPCServer())
-server.serve_forever()
+    if args.peers[0] is not None and args.frontends[0] is not None:
+        parser.error("--peers and --frontends are exclusive")
+    peers = None
+    if args.peers[0] is not None:
+        peers = [int(i) for i in args.peers[0].split(',')]
+    frontends = None
+    if args.frontends[0] is not None:
+        frontends = [int(i) for i in args.frontends[0].split(',')]
+    server = SimpleThreadedXMLRPCServer(("localhost", frontendPort + args.frontendId[0]))
+    server.register_instance(FrontendRPCServer(args.timeout[0], args.rpcTimeout[0],
+                                               read_policy=args.readPolicy[0],
+                                               hedge_percentile=args.hedgePercentile[0],
+                                               hedge_ratio=args.hedgeRatio[0],
+                                               cache_mode=args.cacheMode[0],
+                                               cache_bytes=args.cacheBytes[0],
+                                               log_dir=args.logDir[0],
+                                               log_mode=args.logMode[0],
+                                               replication=args.replication[0],
+                                               max_lag=args.maxLag[0],
+                                               frontend_id=args.frontendId[0],
+                                               peers=peers,
+                                               raft_dir=args.raftDir[0],
+                                               frontends=frontends,
+                                               lease=args.lease[0]))
+    server.serve_forever()
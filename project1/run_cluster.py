@@ -1,6 +1,13 @@
 import argparse
+import atexit
+import csv
+import multiprocessing
 import os
+import shlex
 import subprocess
+import sys
+import tempfile
+import threading
 
 import time
 import random
@@ -8,7 +15,21 @@ import xmlrpc.client
 
 import concurrent.futures
 
+# Only sweep plots need matplotlib; without it sweeps just write the table
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+from shared import results
+from shared import rpc
 from shared import util
+from shared.histogram import Histogram
+from shared.partition import partition_of
+from shared.timeline import Timeline, availability
+from shared.workload import Values, Workload
 
 baseAddr = "http://localhost:"
 baseClientPort = 7000
@@ -21,30 +42,92 @@ serverUID = 0
 frontend = None
 clientList = dict()
 
+# Budget (seconds) each client request carries through the frontend to the
+# servers. Proxies wait a little longer so the budget expires downstream first.
+requestBudget = 5.0
+adminTimeout = 60.0
+
+# Multi-process driver: with processes= on testKVS, or agents given by
+# --agents, each phase runs in worker processes (see driveWorker and
+# agent.py) that drive a share of the threads each, instead of as threads
+# of this process. Workers only talk to clients; the cluster itself,
+# including failure injection, stays with this process. In a worker,
+# failureHook stands in for injectFailure and asks the coordinator to do it.
+agents = []
+failureHook = None
+
+# Run-phase timeline (timeline= on testKVS): operations per interval in
+# every process, and the events (failures injected, server list changes)
+# marked by this one as (seconds into the run, text).
+runTimeline = None
+runEvents = []
+
+# Sized values (value_size= on testKVS): testKVS keys its load and run
+# values by number, and payload turns a number into the binary value that
+# is put, the same in every driver process. None stores the numbers.
+runValues = None
+
+# Directory each testKVS run saves its result file in (--results), unless
+# result= names the file
+resultsDir = "results"
+
+# Local backend (--local): nodes run as subprocesses on loopback ports
+# instead of pods, and k8s_client is None throughout. localProcs maps pod
+# names such as 'server-pod-0' to their Popen objects; each node's output
+# goes to <name>.log under localDir.
+localProcs = dict()
+localArgs = {'frontend': [], 'server': [], 'client': []}
+localDir = None
+
+def start_process(prefix, node_type, port, node_id=None):
+    command = [sys.executable, os.path.join(prefix, node_type + '.py')]
+    name = node_type + '-pod'
+    if node_id is not None:
+        command += ['-i', str(node_id)]
+        name += '-%d' % node_id
+    command += localArgs[node_type]
+    with open(os.path.join(localDir, name + '.log'), 'w') as log:
+        process = subprocess.Popen(command, cwd=prefix, stdout=log, stderr=subprocess.STDOUT)
+    localProcs[name] = process
+    util.check_wait_port(process, port)
+
+def stop_processes():
+    for process in localProcs.values():
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
 def add_nodes(k8s_client, k8s_apps_client, node_type, num_nodes, prefix=None):
     global clientUID
     global serverUID
 
     for i in range(0, num_nodes):
         if node_type == 'server':
-            server_spec = util.load_yaml('yaml/pods/server-pod.yml', prefix)
-            env = server_spec['spec']['containers'][0]['env']
-            util.replace_yaml_val(env, 'SERVER_ID', str(serverUID))
-            server_spec['metadata']['name'] = 'server-pod-%d' % serverUID
-            server_spec['metadata']['labels']['role'] = 'server-%d' % serverUID
-            k8s_client.create_namespaced_pod(namespace=util.NAMESPACE, body=server_spec)
-            util.check_wait_pod_status(k8s_client, 'role=server-%d' % serverUID, 'Running')
+            if k8s_client is None:
+                start_process(prefix, 'server', baseServerPort + serverUID, serverUID)
+            else:
+                server_spec = util.load_yaml('yaml/pods/server-pod.yml', prefix)
+                env = server_spec['spec']['containers'][0]['env']
+                util.replace_yaml_val(env, 'SERVER_ID', str(serverUID))
+                server_spec['metadata']['name'] = 'server-pod-%d' % serverUID
+                server_spec['metadata']['labels']['role'] = 'server-%d' % serverUID
+                k8s_client.create_namespaced_pod(namespace=util.NAMESPACE, body=server_spec)
+                util.check_wait_pod_status(k8s_client, 'role=server-%d' % serverUID, 'Running')
             result = frontend.addServer(serverUID)
             serverUID += 1
         elif node_type == 'client':
-            client_spec = util.load_yaml('yaml/pods/client-pod.yml', prefix)
-            env = client_spec['spec']['containers'][0]['env']
-            util.replace_yaml_val(env, 'CLIENT_ID', str(clientUID))
-            client_spec['metadata']['name'] = 'client-pod-%d' % clientUID
-            client_spec['metadata']['labels']['role'] = 'client-%d' % clientUID
-            k8s_client.create_namespaced_pod(namespace=util.NAMESPACE, body=client_spec)
-            util.check_wait_pod_status(k8s_client, 'role=client-%d' % clientUID, 'Running')
-            clientList[clientUID] = xmlrpc.client.ServerProxy(baseAddr + str(baseClientPort + clientUID))
+            if k8s_client is None:
+                start_process(prefix, 'client', baseClientPort + clientUID, clientUID)
+            else:
+                client_spec = util.load_yaml('yaml/pods/client-pod.yml', prefix)
+                env = client_spec['spec']['containers'][0]['env']
+                util.replace_yaml_val(env, 'CLIENT_ID', str(clientUID))
+                client_spec['metadata']['name'] = 'client-pod-%d' % clientUID
+                client_spec['metadata']['labels']['role'] = 'client-%d' % clientUID
+                k8s_client.create_namespaced_pod(namespace=util.NAMESPACE, body=client_spec)
+                util.check_wait_pod_status(k8s_client, 'role=client-%d' % clientUID, 'Running')
+            clientList[clientUID] = rpc.proxy(baseAddr + str(baseClientPort + clientUID),
+                                              requestBudget + 1)
             clientUID += 1
         else:
             print("Unknown pod type")
@@ -52,6 +135,13 @@ def add_nodes(k8s_client, k8s_apps_client, node_type, num_nodes, prefix=None):
 
 def remove_node(k8s_client, k8s_apps_client, node_type, node_id):
     name = node_type + '-pod-%d' % node_id
+    if k8s_client is None:
+        # Killed outright, like a deleted pod
+        if name in localProcs:
+            process = localProcs.pop(name)
+            process.kill()
+            process.wait()
+        return
     selector = 'role=' + node_type + '-%d' % node_id
     k8s_client.delete_namespaced_pod(name, namespace=util.NAMESPACE)
     util.check_wait_pod_status(k8s_client, selector, 'Terminating')
@@ -62,6 +152,14 @@ def addClient(k8s_client, k8s_apps_client, prefix):
 def addServer(k8s_client, k8s_apps_client, prefix):
     add_nodes(k8s_client, k8s_apps_client, 'server', 1, prefix)
 
+# removeClient: Remove the newest client, so client ids stay 0..n-1 as
+# testKVS threads expect.
+def removeClient(k8s_client, k8s_apps_client):
+    global clientUID
+    clientUID -= 1
+    remove_node(k8s_client, k8s_apps_client, 'client', clientUID)
+    del clientList[clientUID]
+
 def listServer():
     result = frontend.listServer()
     print(result)
@@ -74,31 +172,325 @@ def shutdownServer(k8s_client, k8s_apps_client, serverId):
     print(result)
 
 def put(key, value):
-    result = clientList[random.choice(list(clientList.keys()))].put(key, value)
+    result = clientList[random.choice(list(clientList.keys()))].put(key, value, requestBudget)
     print(result)
 
 def get(key):
-    result = clientList[random.choice(list(clientList.keys()))].get(key)
-    print(result)
+    result = clientList[random.choice(list(clientList.keys()))].get(key, requestBudget)
+    print(shown(result))
+
+def metrics():
+    print("Frontend: " + str(frontend.getMetrics()))
+    for serverId, serverMetrics in sorted(listMetrics().items()):
+        print(f"Server {serverId}: " + str(serverMetrics))
+    for clientId in sorted(clientList.keys()):
+        print(f"Client {clientId}: " + str(clientList[clientId].getMetrics()))
+
+# listMetrics: serverId -> metrics (including keys and value bytes held) of
+# each server the frontend lists.
+def listMetrics():
+    servers = frontend.listServer()
+    if servers == "ERR_NOSERVERS":
+        return {}
+    serverMetrics = {}
+    for serverId in [int(i) for i in servers.split(',')]:
+        try:
+            serverMetrics[serverId] = rpc.proxy(baseAddr + str(baseServerPort + serverId),
+                                                adminTimeout).getMetrics()
+        except:
+            pass
+    return serverMetrics
 
 def printKVPairs(serverId):
     result = frontend.printKVPairs(serverId)
     print(result)
 
-def loadDataset(thread_id, keys, load_vals, num_threads):
+# record: Add one operation's latency to a thread's histograms, and to the
+# timeline when one is kept (and timeline is set). Failed operations go to
+# "<op> failed".
+def record(histograms, op, start, ok=True, timeline=True):
+    seconds = time.perf_counter() - start
+    if runTimeline is not None and timeline:
+        runTimeline.record(time.time(), seconds, ok)
+    if not ok:
+        op += " failed"
+    if op not in histograms:
+        histograms[op] = Histogram()
+    histograms[op].record(seconds)
+
+def succeeded(results):
+    return not any(not rpc.is_binary(result) and str(result).startswith("ERR_") and
+                   result != "ERR_KEY" for result in results)
+
+# payload: The value testKVS puts for value number n.
+def payload(n):
+    return n if runValues is None else runValues.value_of(n)
+
+# matches: Whether a get of key returned value number n.
+def matches(result, key, n):
+    if runValues is not None:
+        return result == runValues.value_of(n)
+    result = result.split(':')
+    return int(result[0]) == key and int(result[1]) == n
+
+# shown: A get result for printing, with a binary value as its size.
+def shown(result):
+    return f"<{len(result.data)} bytes>" if rpc.is_binary(result) else result
+
+def merge(thread_histograms):
+    merged = dict()
+    for histograms in thread_histograms:
+        for op, histogram in histograms.items():
+            merged.setdefault(op, Histogram()).merge(histogram)
+    return merged
+
+# report: Print the latency percentiles of each operation type, merging the
+# histograms the threads kept.
+def report(phase, thread_histograms):
+    merged = merge(thread_histograms)
+    for op in sorted(merged):
+        print(f"{phase} {op} latency (ms): " + merged[op].format())
+
+def loadDataset(thread_id, keys, load_vals, num_threads, histograms):
     start_idx = int((len(keys) / num_threads) * thread_id)
     end_idx = int(start_idx + (int((len(keys) / num_threads))))
 
     for idx in range(start_idx, end_idx):
         try:
-            result = clientList[thread_id].put(keys[idx], load_vals[idx])
+            start = time.perf_counter()
+            result = clientList[thread_id].put(keys[idx], payload(load_vals[idx]), requestBudget)
+            record(histograms, "put", start)
         except:
             print(f"[Error in thread {thread_id}] put request fail, key = {keys[idx]}, val = {load_vals[idx]}")
             return
 
+# dataset: (key, value) pairs to bulk load, one at a time so that the whole
+# dataset is never in memory: the key,value lines of the CSV file source,
+# or else keys 0..num_keys-1 with values of value_size bytes (a count or a
+# "min-max" range), or the key itself without one.
+def dataset(source=None, num_keys=0, value_size=None):
+    if source is not None:
+        with open(source, newline='') as f:
+            for row in csv.reader(f):
+                if len(row) >= 2:
+                    yield row[0], row[1]
+        return
+    values = None if value_size is None else Values(value_size)
+    rng = random.Random()
+    for key in range(num_keys):
+        yield key, key if values is None else values.value(rng)
+
+# sendBatch: bulk_load a batch on the frontend at addr, following a frontend
+# group to its leader. Keys it still rejects are put one at a time through
+# a client. Returns how many keys could not be loaded.
+def sendBatch(addr, data, histograms):
+    start = time.perf_counter()
+    for attempt in range(10):
+        rejected = rpc.proxy(addr, adminTimeout).bulk_load(data, adminTimeout)
+        leaders = set(error.split(':', 1)[1] for error in rejected.values()
+                      if error.startswith("ERR_NOTLEADER:"))
+        if len(rejected) < len(data) or len(leaders) != 1:
+            break
+        addr = leaders.pop() or addr
+        time.sleep(.05)
+    record(histograms, "bulk_load", start, len(rejected) == 0)
+    failed = 0
+    client = rpc.proxy(baseAddr + str(baseClientPort + min(clientList)), requestBudget + 1)
+    for key in rejected:
+        start = time.perf_counter()
+        result = client.put(key, data[key], requestBudget)
+        record(histograms, "put", start, str(result).startswith("Success"))
+        if not str(result).startswith("Success"):
+            failed += 1
+    return failed
+
+# bulkLoad: Preload the (key, value) pairs with the frontends' bulk_load
+# instead of one put per key: the pairs are split by owning frontend and
+# sent in batches of batch keys, streams batches at a time. Returns the
+# number of keys, how many failed, the seconds it took and the histograms.
+def bulkLoad(pairs, batch=10000, streams=4):
+    start = time.time()
+    addrs = frontend.getMembership()["frontends"] or [baseAddr + str(baseFrontendPort)]
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=streams)
+    # At most two batches per stream are waiting in memory
+    slots = threading.BoundedSemaphore(streams * 2)
+    buffers = [dict() for _ in addrs]
+    histograms = []
+    futures = []
+    count = 0
+    for key, value in pairs:
+        owner = 0 if len(addrs) == 1 else partition_of(key, len(addrs))
+        buffers[owner][str(key)] = value
+        count += 1
+        if len(buffers[owner]) >= batch:
+            slots.acquire()
+            histograms.append(dict())
+            future = pool.submit(sendBatch, addrs[owner], buffers[owner], histograms[-1])
+            future.add_done_callback(lambda future: slots.release())
+            futures.append((future, len(buffers[owner])))
+            buffers[owner] = dict()
+    for owner, data in enumerate(buffers):
+        if len(data) > 0:
+            histograms.append(dict())
+            futures.append((pool.submit(sendBatch, addrs[owner], data, histograms[-1]), len(data)))
+    pool.shutdown(wait=True)
+    failed = 0
+    for future, size in futures:
+        try:
+            failed += future.result()
+        except Exception as e:
+            print(f"[Error] bulk_load failed: {e}")
+            failed += size
+    return count, failed, time.time() - start, histograms
+
+def injectFailure(k8s_client, k8s_apps_client, prefix, crash_server, add_server, remove_server):
+    if failureHook is not None:
+        failureHook()
+        return
+    if crash_server == 1:
+        event = "killServer:0"
+    elif add_server == 1:
+        event = "addServer"
+    elif remove_server == 1:
+        event = "shutdownServer:0"
+    else:
+        return
+    mark(event)
+    if crash_server == 1:
+        killServer(k8s_client, k8s_apps_client, 0)
+    elif add_server == 1:
+        addServer(k8s_client, k8s_apps_client, prefix)
+    else:
+        shutdownServer(k8s_client, k8s_apps_client, 0)
+    mark(event + " done")
+
+def mark(event):
+    if runTimeline is not None:
+        runEvents.append((round(time.time() - runTimeline.start, 3), event))
+
+# monitor: Mark each change of the frontend's server list until stop is set,
+# which shows when a failure was detected.
+def monitor(stop):
+    admin = rpc.proxy(baseAddr + str(baseFrontendPort), 1.0)
+    last = None
+    while not stop.wait(runTimeline.interval):
+        try:
+            servers = admin.listServer()
+        except Exception:
+            servers = "unreachable"
+        if last is not None and servers != last:
+            mark("servers: " + servers)
+        last = servers
+
+# ycsbOp: Perform the next workload operation through client. Returns the
+# operation, its key(s) and the results it got.
+def ycsbOp(client, workload, rng):
+    op, key = workload.next_op(rng)
+    if op == "read":
+        results = [client.get(key, requestBudget)]
+    elif op == "scan":
+        results = list(client.get_many(key, requestBudget).values())
+    elif op == "rmw":
+        results = [client.get(key, requestBudget),
+                   client.put(key, workload.value(rng), requestBudget)]
+    else:
+        results = [client.put(key, workload.value(rng), requestBudget)]
+    return op, key, results
+
+# tally: Count op in counts, and its not-found and error results.
+def tally(counts, op, results):
+    counts[op] = counts.get(op, 0) + 1
+    for result in results:
+        if result == "ERR_KEY":
+            counts["not_found"] += 1
+        elif not rpc.is_binary(result) and result.startswith("ERR_"):
+            counts["errors"] += 1
+
+# runYCSB: Run num_requests operations of a YCSB-style workload. Errors are
+# counted rather than ending the thread; a read of a key not written yet
+# (a latest read racing its insert) counts as not_found. Returns the counts.
+def runYCSB(k8s_client, k8s_apps_client, prefix, thread_id, workload, num_requests,
+            crash_server, add_server, remove_server, histograms):
+    rng = random.Random()
+    client = clientList[thread_id]
+    counts = {"errors": 0, "not_found": 0}
+    for request_count in range(num_requests):
+        if thread_id == 0 and request_count == int(num_requests / 2):
+            injectFailure(k8s_client, k8s_apps_client, prefix, crash_server, add_server, remove_server)
+        try:
+            start = time.perf_counter()
+            op, key, results = ycsbOp(client, workload, rng)
+            record(histograms, op, start, succeeded(results))
+        except Exception as e:
+            record(histograms, "failed", start, False)
+            print(f"[Error in thread {thread_id}] request fail", e)
+            return counts
+        tally(counts, op, results)
+    return counts
+
+# runOpenLoop: Send num_requests requests at rate ops/sec with Poisson
+# arrivals, whether or not earlier ones have completed, from up to
+# concurrency workers spread over the clients. Latency is measured from
+# the time each request was due to be sent, so requests queued behind a
+# slow cluster count their wait (no coordinated omission); "<op> service"
+# is measured from when it was actually sent. Returns operation and error
+# counts, and the per-worker histograms in thread_histograms.
+def runOpenLoop(k8s_client, k8s_apps_client, prefix, rate, num_requests, concurrency,
+                workload, keys, run_vals, put_ratio, crash_server, add_server, remove_server,
+                thread_histograms):
+    counts = {"errors": 0, "not_found": 0}
+    lock = threading.Lock()
+    local = threading.local()
+    clientIds = sorted(clientList.keys())
+
+    def send(intended):
+        if not hasattr(local, "client"):
+            with lock:
+                clientId = clientIds[len(thread_histograms) % len(clientIds)]
+                local.histograms = dict()
+                thread_histograms.append(local.histograms)
+            local.client = rpc.proxy(baseAddr + str(baseClientPort + clientId), requestBudget + 1)
+            local.rng = random.Random()
+        start = time.perf_counter()
+        try:
+            if workload is not None:
+                op, key, results = ycsbOp(local.client, workload, local.rng)
+            else:
+                idx = local.rng.randrange(len(keys))
+                if local.rng.random() * 100 < put_ratio:
+                    op, results = "put", [local.client.put(keys[idx], payload(run_vals[idx]),
+                                                          requestBudget)]
+                else:
+                    op, results = "get", [local.client.get(keys[idx], requestBudget)]
+        except Exception:
+            op, results = "failed", ["ERR_EXCEPTION"]
+        ok = succeeded(results)
+        record(local.histograms, op, intended, ok)
+        if ok:
+            record(local.histograms, op + " service", start, timeline=False)
+        with lock:
+            tally(counts, op, results)
+
+    rng = random.Random()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    intended = time.perf_counter()
+    for request_count in range(num_requests):
+        if request_count == int(num_requests / 2) and (crash_server or add_server or remove_server):
+            injector = threading.Thread(target=injectFailure, args=(
+                k8s_client, k8s_apps_client, prefix, crash_server, add_server, remove_server))
+            injector.start()
+        intended += rng.expovariate(rate)
+        delay = intended - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        pool.submit(send, intended)
+    pool.shutdown(wait=True)
+    return counts
+
 def runWorkload(k8s_client, k8s_apps_client, prefix, thread_id,
                 keys, load_vals, run_vals, num_threads, num_requests,
-                put_ratio, test_consistency, crash_server, add_server, remove_server):
+                put_ratio, test_consistency, crash_server, add_server, remove_server,
+                histograms):
     request_count = 0
     start_idx = int((len(keys) / num_threads) * thread_id)
     end_idx = int(start_idx + (int((len(keys) / num_threads))))
@@ -107,26 +499,26 @@ def runWorkload(k8s_client, k8s_apps_client, prefix, thread_id,
         while num_requests > request_count:
             idx = random.randint(start_idx, end_idx - 1)
             if thread_id == 0 and request_count == int(num_requests / 2):
-                if crash_server == 1:
-                    killServer(k8s_client, k8s_apps_client, 0)
-                elif add_server == 1:
-                    addServer(k8s_client, k8s_apps_client, prefix)
-                elif remove_server == 1:
-                    shutdownServer(k8s_client, k8s_apps_client, 0)
+                injectFailure(k8s_client, k8s_apps_client, prefix, crash_server, add_server, remove_server)
             newval = random.randint(0, 1000000)
             try:
-                clientList[thread_id].put(keys[idx], newval)
+                start = time.perf_counter()
+                result = clientList[thread_id].put(keys[idx], payload(newval), requestBudget)
+                record(histograms, "put", start, succeeded([result]))
             except:
+                record(histograms, "put", start, False)
                 print(f"[Error in thread {thread_id}] put request fail, key = {keys[idx]}, val = {newval}")
                 return
 
             try:
-                result = clientList[thread_id].get(keys[idx])
-                result = result.split(':')
-                if int(result[0]) != keys[idx] or int(result[1]) != newval:
-                    print(f"[Error] request = ({keys[idx]}, {load_vals[idx]}), return = ({int(result[0])}, {int(result[1])})")
+                start = time.perf_counter()
+                result = clientList[thread_id].get(keys[idx], requestBudget)
+                record(histograms, "get", start, succeeded([result]))
+                if not matches(result, keys[idx], newval):
+                    print(f"[Error] request = ({keys[idx]}, {newval}), return = {shown(result)}")
                     return
             except:
+                record(histograms, "get", start, False)
                 print(f"[Error in thread {thread_id}] get request fail, key = {keys[idx]}")
                 return
             request_count += 1
@@ -145,18 +537,23 @@ def runWorkload(k8s_client, k8s_apps_client, prefix, thread_id,
                     break
                 if optype[idx % 100] == "Put":
                     try:
-                        result = clientList[thread_id].put(keys[idx], run_vals[idx])
+                        start = time.perf_counter()
+                        result = clientList[thread_id].put(keys[idx], payload(run_vals[idx]), requestBudget)
+                        record(histograms, "put", start, succeeded([result]))
                     except Exception as e:
+                        record(histograms, "put", start, False)
                         print(f"[Error in thread {thread_id}] put request fail, key = {keys[idx]}, val = {run_vals[idx]}", e)
                         return
                 elif optype[idx % 100] == "Get":
                     try:
-                        result = clientList[thread_id].get(keys[idx])
-                        result = result.split(':')
-                        if int(result[0]) != keys[idx] or int(result[1]) != load_vals[idx]:
-                            print(f"[Error] request = ({keys[idx]}, {load_vals[idx]}), return = ({int(result[0])}, {int(result[1])})")
+                        start = time.perf_counter()
+                        result = clientList[thread_id].get(keys[idx], requestBudget)
+                        record(histograms, "get", start, succeeded([result]))
+                        if not matches(result, keys[idx], load_vals[idx]):
+                            print(f"[Error] request = ({keys[idx]}, {load_vals[idx]}), return = {shown(result)}")
                             return
                     except Exception as e:
+                        record(histograms, "get", start, False)
                         print(f"[Error in thread {thread_id}] get request fail, key = {keys[idx]}", e)
                         return
                 else:
@@ -164,9 +561,154 @@ def runWorkload(k8s_client, k8s_apps_client, prefix, thread_id,
                     return
                 request_count += 1
 
+# loadPhase: Load the given threads' shares of the dataset. Returns their
+# histograms and (no) operation counts.
+def loadPhase(thread_ids, keys, load_vals, num_threads):
+    histograms = [dict() for _ in thread_ids]
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(thread_ids))
+    for i, thread_id in enumerate(thread_ids):
+        pool.submit(loadDataset, thread_id, keys, load_vals, num_threads, histograms[i])
+    pool.shutdown(wait=True)
+    return histograms, dict()
+
+# runPhase: Run the given threads. Open loop, they get their share of the
+# rate, requests and concurrency. Returns histograms and operation counts.
+def runPhase(k8s_client, k8s_apps_client, prefix, thread_ids, keys, load_vals, run_vals,
+             num_threads, num_requests, put_ratio, test_consistency, crash_server,
+             add_server, remove_server, workload, rate, concurrency):
+    share = len(thread_ids) / num_threads
+    if rate is not None:
+        histograms = []
+        counts = runOpenLoop(k8s_client, k8s_apps_client, prefix, rate * share,
+                             int(num_requests * share), max(1, int(concurrency * share)),
+                             workload, keys, run_vals, put_ratio,
+                             crash_server, add_server, remove_server, histograms)
+        return histograms, counts
+
+    histograms = [dict() for _ in thread_ids]
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(thread_ids))
+    futures = []
+    for i, thread_id in enumerate(thread_ids):
+        if workload is not None:
+            futures.append(pool.submit(runYCSB, k8s_client, k8s_apps_client, prefix,
+                                       thread_id, workload, int(num_requests / num_threads),
+                                       crash_server, add_server, remove_server,
+                                       histograms[i]))
+        else:
+            pool.submit(runWorkload, k8s_client, k8s_apps_client, prefix,
+                        thread_id, keys, load_vals, run_vals,
+                        num_threads, int(num_requests / num_threads), put_ratio,
+                        test_consistency, crash_server, add_server, remove_server,
+                        histograms[i])
+    pool.shutdown(wait=True)
+    counts = dict()
+    for future in futures:
+        for name, count in future.result().items():
+            counts[name] = counts.get(name, 0) + count
+    return histograms, counts
+
+# driveWorker: Run one worker's share of a phase, as described by spec, in
+# this process. Returns its merged histograms (as dicts), counts and the
+# seconds the phase took here.
+def driveWorker(spec, halfway=None):
+    global requestBudget, failureHook, runTimeline, runValues
+    requestBudget = spec["budget"]
+    runTimeline = None
+    if spec.get("timeline") is not None:
+        runTimeline = Timeline(*spec["timeline"])
+    if halfway is not None:
+        failureHook = halfway.set
+    clientList.clear()
+    for thread_id, addr in spec["clients"]:
+        clientList[thread_id] = rpc.proxy(addr, requestBudget + 1)
+    workload = None
+    runValues = None
+    if spec.get("workload") is not None:
+        name, distribution = spec["workload"]
+        value_size, value_distribution = spec["values"]
+        workload = Workload(name, len(spec["keys"]), distribution or None, value_size, keys=spec["keys"],
+                            insert_offset=spec["worker"], insert_stride=spec["workers"],
+                            value_distribution=value_distribution or None)
+        runValues = workload.values
+    elif spec.get("values") is not None:
+        runValues = Values(*spec["values"])
+    start = time.time()
+    if spec["phase"] == "load":
+        histograms, counts = loadPhase(spec["threads"], spec["keys"], spec["load_vals"],
+                                       spec["num_threads"])
+    else:
+        histograms, counts = runPhase(None, None, None, spec["threads"], spec["keys"],
+                                      spec["load_vals"], spec["run_vals"], spec["num_threads"],
+                                      spec["num_requests"], spec["put_ratio"],
+                                      spec["test_consistency"], spec["crash_server"],
+                                      spec["add_server"], spec["remove_server"], workload,
+                                      spec.get("rate"), spec["concurrency"])
+    elapsed = time.time() - start
+    merged = merge(histograms)
+    result = {"histograms": {op: h.to_dict() for op, h in merged.items()},
+              "counts": counts, "elapsed": elapsed}
+    if runTimeline is not None:
+        result["timeline"] = runTimeline.to_dict()
+    return result
+
+# distribute: Run a phase over processes local worker processes and the
+# agents, dealing the threads out round robin. The first worker is always
+# local and holds thread 0, which signals when a failure is due. Returns
+# histograms, counts and the seconds the slowest worker took.
+def distribute(k8s_client, k8s_apps_client, prefix, spec, processes):
+    workers = min(processes + len(agents), spec["num_threads"])
+    processes = max(1, min(processes, workers))
+    specs = []
+    for worker in range(workers):
+        part = dict(spec)
+        part["worker"] = worker
+        part["workers"] = workers
+        part["threads"] = list(range(worker, spec["num_threads"], workers))
+        part["clients"] = [[t, baseAddr + str(baseClientPort + t)] for t in part["threads"]]
+        if worker != 0:
+            part["crash_server"] = part["add_server"] = part["remove_server"] = 0
+        specs.append(part)
+    manager = multiprocessing.Manager()
+    halfway = manager.Event()
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+    futures = [pool.submit(driveWorker, specs[0], halfway)]
+    futures += [pool.submit(driveWorker, part) for part in specs[1:processes]]
+    remote = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers - processes))
+    # xmlrpc has no None, so agents get the spec without the unset entries
+    futures += [remote.submit(lambda addr, part: rpc.proxy(addr).drive(part), agents[i],
+                              {name: value for name, value in part.items() if value is not None})
+                for i, part in enumerate(specs[processes:])]
+    if spec["crash_server"] or spec["add_server"] or spec["remove_server"]:
+        while not all(future.done() for future in futures):
+            if halfway.wait(0.1):
+                injectFailure(k8s_client, k8s_apps_client, prefix, spec["crash_server"],
+                              spec["add_server"], spec["remove_server"])
+                break
+    results = [future.result() for future in futures]
+    pool.shutdown()
+    remote.shutdown()
+    manager.shutdown()
+    histograms = [{op: Histogram.from_dict(h) for op, h in result["histograms"].items()}
+                  for result in results]
+    for result in results:
+        if "timeline" in result:
+            runTimeline.merge(Timeline.from_dict(result["timeline"]))
+    counts = dict()
+    for result in results:
+        for name, count in result["counts"].items():
+            counts[name] = counts.get(name, 0) + count
+    return histograms, counts, max(result["elapsed"] for result in results)
+
 def testKVS(k8s_client, k8s_apps_client, prefix, num_keys, num_threads,
             num_requests, put_ratio, test_consistency=0, crash_server=0,
-            add_server=0, remove_server=0):
+            add_server=0, remove_server=0, read_policy=None, hedge_percentile=None,
+            cache_mode=None, workload=None, distribution=None, value_size=None,
+            rate=None, concurrency=64, processes=1, timeline=None, interval=100,
+            result=None, bulk=0, value_distribution=None):
+    # Saved with the result, before any of them change
+    parameters = {name: value for name, value in locals().items()
+                  if name not in ("k8s_client", "k8s_apps_client", "prefix", "result")}
     serverList = frontend.listServer()
     serverList = serverList.split(',')
     if len(serverList) < 1:
@@ -187,34 +729,247 @@ def testKVS(k8s_client, k8s_apps_client, prefix, num_keys, num_threads,
     random.shuffle(load_vals);
     random.shuffle(run_vals);
 
-    pool = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+    # YCSB-style workload: records are the shuffled keys, loaded with
+    # values of value_size bytes. Other runs put binary values of
+    # value_size bytes in place of the value numbers when it is given.
+    global runValues
+    runValues = None
+    workloadArgs = None
+    valuesArgs = None
+    try:
+        if workload is not None:
+            workloadArgs = [workload, distribution or ""]
+            valuesArgs = [str(value_size or 100), value_distribution or ""]
+            workload = Workload(workload, num_keys, distribution, value_size or 100, keys=keys,
+                                value_distribution=value_distribution)
+            runValues = workload.values
+            print(f"Workload = {workload.mix}, distribution = {workload.distribution}")
+        elif value_size is not None:
+            valuesArgs = [str(value_size), value_distribution or ""]
+            runValues = Values(value_size, value_distribution)
+    except ValueError as e:
+        print(f"[Error] {e}")
+        return
+    if runValues is not None:
+        print(f"Value sizes = {runValues.sizes[0]}-{runValues.sizes[1]} bytes, " +
+              f"distribution = {runValues.distribution}")
+
+    # Frontend tunables for this run
+    settings = {}
+    if read_policy is not None:
+        settings["read_policy"] = read_policy
+    if hedge_percentile is not None:
+        settings["hedge_percentile"] = float(hedge_percentile)
+    if cache_mode is not None:
+        settings["cache_mode"] = cache_mode
+    if len(settings) > 0:
+        result = frontend.configure(settings)
+        if result != "Success":
+            print(f"[Error] {result}")
+            return
+        print("Frontend settings = " + str(settings))
+
+    rate = None if rate is None else float(rate)
+    concurrency = int(concurrency)
+    processes = int(processes)
+    spec = {"budget": requestBudget, "workload": workloadArgs, "values": valuesArgs, "keys": keys,
+            "load_vals": load_vals, "run_vals": run_vals, "num_threads": num_threads,
+            "num_requests": num_requests, "put_ratio": put_ratio,
+            "test_consistency": test_consistency, "crash_server": crash_server,
+            "add_server": add_server, "remove_server": remove_server,
+            "rate": rate, "concurrency": concurrency}
+    if processes > 1 or len(agents) > 0:
+        print(f"Driving from {processes} processes and {len(agents)} agents")
+
+    # Latency histograms per thread and operation type, merged for the report
+    # bulk=1 preloads with bulk_load batches instead of a put per key
     start = time.time()
-    for thread_id in range(0, num_threads):
-        pool.submit(loadDataset, thread_id, keys, load_vals, num_threads)
-    pool.shutdown(wait=True)
-    end = time.time()
-    print("Load throughput = " + str(round(num_keys/(end - start), 1)) + "ops/sec")
+    if int(bulk) == 1:
+        _, failed, elapsed, histograms = bulkLoad(zip(keys, map(payload, load_vals)))
+        if failed > 0:
+            print(f"[Warning] {failed} keys failed to load")
+    elif processes > 1 or len(agents) > 0:
+        spec["phase"] = "load"
+        histograms, counts, elapsed = distribute(k8s_client, k8s_apps_client, prefix, spec, processes)
+    else:
+        histograms, counts = loadPhase(list(range(num_threads)), keys, load_vals, num_threads)
+        elapsed = time.time() - start
+    print("Load throughput = " + str(round(num_keys/elapsed, 1)) + "ops/sec")
+    report("Load", histograms)
+    loadResult = results.phase_result(num_keys, elapsed, merge(histograms))
+
+    # Timeline of the run phase, with server list changes marked
+    global runTimeline, runEvents
+    if timeline is not None:
+        runTimeline = Timeline(time.time(), float(interval) / 1000)
+        runEvents = []
+        spec["timeline"] = [runTimeline.start, runTimeline.interval]
+        stop = threading.Event()
+        watcher = threading.Thread(target=monitor, args=(stop,))
+        watcher.start()
 
-    pool = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+    # Open loop (rate): requests arrive at rate ops/sec instead of one per
+    # thread after the last completes
     start = time.time()
-    for thread_id in range(0, num_threads):
-        pool.submit(runWorkload, k8s_client, k8s_apps_client, prefix,
-                    thread_id, keys, load_vals, run_vals,
-                    num_threads, int(num_requests / num_threads), put_ratio,
-                    test_consistency, crash_server, add_server, remove_server)
-    pool.shutdown(wait=True)
-    end = time.time()
-    print("Run throughput = " + str(round(num_requests/(end - start), 1)) + "ops/sec")
+    if processes > 1 or len(agents) > 0:
+        spec["phase"] = "run"
+        histograms, counts, elapsed = distribute(k8s_client, k8s_apps_client, prefix, spec, processes)
+    else:
+        histograms, counts = runPhase(k8s_client, k8s_apps_client, prefix, list(range(num_threads)),
+                                      keys, load_vals, run_vals, num_threads, num_requests,
+                                      put_ratio, test_consistency, crash_server, add_server,
+                                      remove_server, workload, rate, concurrency)
+        elapsed = time.time() - start
+    if rate is not None:
+        print(f"Target rate = {rate}ops/sec")
+    print("Run throughput = " + str(round(num_requests/elapsed, 1)) + "ops/sec")
+    report("Run", histograms)
+    if workload is not None or rate is not None:
+        print("Operations = " + str(counts))
+    runResult = results.phase_result(num_requests, elapsed, merge(histograms), counts)
+
+    if timeline is not None:
+        stop.set()
+        watcher.join()
+        runTimeline.write(timeline, runEvents)
+        print(f"Timeline written to {timeline}")
+        injected = [at for at, event in runEvents if not event.startswith("servers:") and
+                    not event.endswith(" done")]
+        if len(injected) > 0:
+            outage = availability(runTimeline.rows(), injected[0], runTimeline.interval)
+            detected = [at for at, event in runEvents if event.startswith("servers:") and at >= injected[0]]
+            detection = round(detected[0] - injected[0], 3) if len(detected) > 0 else None
+            print(f"Failure at {injected[0]}s: detection = {detection}s, unavailable = " +
+                  f"{outage['unavailable']}s, recovery = {outage['recovery']}s " +
+                  f"(baseline {outage['baseline']}ops/sec)")
+            runResult["availability"] = dict(outage, detection=detection, failure=injected[0])
+        runResult["events"] = [list(event) for event in runEvents]
+        runTimeline = None
+
+    serverMetrics = listMetrics()
+    if len(serverMetrics) > 0:
+        held = [m["value_bytes"] for m in serverMetrics.values()]
+        print(f"Server value bytes = {round(sum(held) / len(held) / 1e6, 3)}MB per server " +
+              f"({len(held)} servers)")
+
+    path = result or results.default_path(resultsDir)
+    results.save(path, {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": results.git_commit(prefix),
+        "parameters": parameters,
+        "cluster": {"backend": "kubernetes" if k8s_client is not None else "local",
+                    "servers": [s.strip() for s in frontend.listServer().split(',')],
+                    "clients": len(clientList), "processes": processes, "agents": len(agents),
+                    "node_args": localArgs if k8s_client is None else {}},
+        "load": loadResult,
+        "run": runResult,
+        "servers": {str(i): m for i, m in serverMetrics.items()}})
+    print(f"Result written to {path}")
+    return results.load(path)
+
+# resize: Add servers and clients, or shut down the newest servers and
+# remove the newest clients, until there are the given numbers.
+def resize(k8s_client, k8s_apps_client, prefix, num_servers, num_clients):
+    active = frontend.listServer()
+    active = [] if active == "ERR_NOSERVERS" else [int(i) for i in active.split(',')]
+    for i in range(len(active), num_servers):
+        addServer(k8s_client, k8s_apps_client, prefix)
+    for serverId in sorted(active, reverse=True)[:max(0, len(active) - num_servers)]:
+        shutdownServer(k8s_client, k8s_apps_client, serverId)
+    while len(clientList) < num_clients:
+        addClient(k8s_client, k8s_apps_client, prefix)
+    while len(clientList) > num_clients:
+        removeClient(k8s_client, k8s_apps_client)
+
+# sweep: Run testKVS for every combination of the comma-separated server
+# counts, client counts, threads, put ratios and value sizes, resizing the
+# cluster before each cell. Other options go to every testKVS. Writes each
+# cell's result, a CSV table and, with matplotlib, plots of run throughput
+# and p99 against the server count to a sweep directory under --results.
+def sweep(k8s_client, k8s_apps_client, prefix, servers="1", clients=None, threads="4",
+          put_ratio="50", value_size=None, keys="1000", requests="4000", **options):
+    directory = os.path.join(resultsDir, time.strftime("sweep-%Y%m%d-%H%M%S"))
+    os.makedirs(directory, exist_ok=True)
+    cells = [(s, c, t, p, v) for s in [int(i) for i in servers.split(',')]
+             for t in [int(i) for i in threads.split(',')]
+             for c in ([t] if clients is None else [int(i) for i in clients.split(',')])
+             for p in [int(i) for i in put_ratio.split(',')]
+             for v in ([None] if value_size is None else value_size.split(','))]
+    rows = []
+    for n, (num_servers, num_clients, num_threads, ratio, size) in enumerate(cells):
+        print(f"[Sweep {n + 1}/{len(cells)}] servers = {num_servers}, clients = {num_clients}, " +
+              f"threads = {num_threads}, put_ratio = {ratio}, value_size = {size}")
+        resize(k8s_client, k8s_apps_client, prefix, num_servers, num_clients)
+        cell = testKVS(k8s_client, k8s_apps_client, prefix, int(keys), num_threads, int(requests),
+                       ratio, value_size=size, result=os.path.join(directory, f"cell-{n}.json"),
+                       **options)
+        if cell is None:
+            continue
+        latency = Histogram()
+        for op, histogram in cell["run"]["histograms"].items():
+            if not op.endswith((" failed", " service")):
+                latency.merge(Histogram.from_dict(histogram))
+        rows.append({"servers": num_servers, "clients": len(clientList), "threads": num_threads,
+                     "put_ratio": ratio, "value_size": size or "",
+                     "load_throughput": cell["load"]["throughput"],
+                     "run_throughput": cell["run"]["throughput"],
+                     "run_p50": latency.summary()["p50"], "run_p99": latency.summary()["p99"],
+                     "errors": cell["load"]["errors"] + cell["run"]["errors"]})
+    if len(rows) == 0:
+        return
+
+    columns = list(rows[0].keys())
+    widths = [max(len(name), max(len(str(row[name])) for row in rows)) for name in columns]
+    print("  ".join(name.rjust(w) for name, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[name]).rjust(w) for name, w in zip(columns, widths)))
+    with open(os.path.join(directory, "sweep.csv"), "w") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    if plt is not None:
+        figure, (top, bottom) = plt.subplots(2, 1, sharex=True, figsize=(8, 8))
+        series = dict()
+        for row in rows:
+            label = f"c={row['clients']} t={row['threads']} put={row['put_ratio']}%"
+            if row["value_size"] != "":
+                label += f" v={row['value_size']}"
+            series.setdefault(label, []).append(row)
+        for label, points in series.items():
+            top.plot([p["servers"] for p in points], [p["run_throughput"] for p in points],
+                     marker="o", label=label)
+            bottom.plot([p["servers"] for p in points], [p["run_p99"] for p in points],
+                        marker="o", label=label)
+        top.set_ylabel("run throughput (ops/sec)")
+        bottom.set_ylabel("run p99 (ms)")
+        bottom.set_xlabel("servers")
+        top.legend(fontsize="small")
+        figure.savefig(os.path.join(directory, "sweep.png"))
+        plt.close(figure)
+    print(f"Sweep written to {directory}")
+
+# compare: Compare two result files and flag regressions beyond threshold
+# percent. Returns the number of regressions.
+def compare(basePath, newPath, threshold=5.0):
+    base = results.load(basePath)
+    new = results.load(newPath)
+    rows = results.compare(base, new, threshold)
+    print(results.format_comparison(base, new, rows))
+    return sum(1 for row in rows if row[4] == "REGRESSION")
 
 def init_cluster(k8s_client, k8s_apps_client, num_client, num_server, ssh_key, prefix):
     global frontend
 
     print('Creating a frontend pod...')
-    frontend_spec = util.load_yaml('yaml/pods/frontend-pod.yml', prefix)
-    env = frontend_spec['spec']['containers'][0]['env']
-    k8s_client.create_namespaced_pod(namespace=util.NAMESPACE, body=frontend_spec)
-    util.check_wait_pod_status(k8s_client, 'role=frontend', 'Running')
-    frontend = xmlrpc.client.ServerProxy(baseAddr + str(baseFrontendPort))
+    if k8s_client is None:
+        start_process(prefix, 'frontend', baseFrontendPort)
+    else:
+        frontend_spec = util.load_yaml('yaml/pods/frontend-pod.yml', prefix)
+        env = frontend_spec['spec']['containers'][0]['env']
+        k8s_client.create_namespaced_pod(namespace=util.NAMESPACE, body=frontend_spec)
+        util.check_wait_pod_status(k8s_client, 'role=frontend', 'Running')
+    frontend = rpc.proxy(baseAddr + str(baseFrontendPort), adminTimeout)
 
     print('Creating server pods...')
     add_nodes(k8s_client, k8s_apps_client, 'server', num_server, prefix)
@@ -225,7 +980,11 @@ def init_cluster(k8s_client, k8s_apps_client, num_client, num_server, ssh_key, p
 def event_trigger(k8s_client, k8s_apps_client, prefix):
     terminate = False
     while terminate != True:
-        cmd = input("Enter a command: ")
+        try:
+            cmd = input("Enter a command: ")
+        except EOFError:
+            # Commands piped in from a script
+            cmd = 'terminate'
         args = cmd.split(':')
 
         if args[0] == 'addClient':
@@ -247,6 +1006,8 @@ def event_trigger(k8s_client, k8s_apps_client, prefix):
         elif args[0] == 'get':
             key = int(args[1])
             get(key)
+        elif args[0] == 'metrics':
+            metrics()
         elif args[0] == 'printKVPairs':
             serverId = int(args[1])
             printKVPairs(serverId)
@@ -259,9 +1020,31 @@ def event_trigger(k8s_client, k8s_apps_client, prefix):
             crash_server = int(args[6])
             add_server = int(args[7])
             remove_server = int(args[8])
+            # Optional trailing name=value settings, e.g. read_policy=p2c
+            options = dict(arg.split('=', 1) for arg in args[9:])
             testKVS(k8s_client, k8s_apps_client, prefix, num_keys, num_threads,
                     num_requests, put_ratio, test_consistency, crash_server,
-                    add_server, remove_server)
+                    add_server, remove_server, **options)
+        elif args[0] == 'bulkLoad':
+            # bulkLoad:<number of keys, or a CSV file of key,value lines>
+            # with optional value_size=, batch= and streams= settings
+            options = dict(arg.split('=', 1) for arg in args[2:])
+            if args[1].isdigit():
+                pairs = dataset(num_keys=int(args[1]), value_size=options.get('value_size'))
+            else:
+                pairs = dataset(args[1])
+            count, failed, elapsed, histograms = bulkLoad(pairs, int(options.get('batch', 10000)),
+                                                          int(options.get('streams', 4)))
+            print(f"Loaded {count - failed} of {count} keys in {round(elapsed, 1)}s (" +
+                  str(round(count / elapsed, 1)) + "keys/sec)")
+            report("Bulk load", histograms)
+        elif args[0] == 'sweep':
+            # name=value options, e.g. sweep:servers=1,2,4:threads=4,8
+            options = dict(arg.split('=', 1) for arg in args[1:])
+            sweep(k8s_client, k8s_apps_client, prefix, **options)
+        elif args[0] == 'compare':
+            threshold = float(args[3]) if len(args) > 3 else 5.0
+            compare(args[1], args[2], threshold)
         elif args[0] == 'terminate':
             terminate = True
         else:
@@ -275,25 +1058,71 @@ if __name__ == '__main__':
                                     in .pub. If no configuration file base is specified, we
                                     use the default ($KVS_HOME/conf/kvs-base.yml).''')
 
-    if 'KVS_HOME' not in os.environ:
-        os.environ['KVS_HOME'] = "/home/" + os.environ['USER'] + "/projects/cs380d-f23/project1/"
-
     parser.add_argument('-c', '--client', nargs=1, type=int, metavar='C',
                         help='The number of client nodes to start with ' +
-                        '(required)', dest='client', required=True)
+                        '(required)', dest='client')
     parser.add_argument('-s', '--server', nargs=1, type=int, metavar='S',
                         help='The number of server nodes to start with ' +
-                        '(required)', dest='server', required=True)
+                        '(required)', dest='server')
     parser.add_argument('--ssh-key', nargs='?', type=str,
                         help='The SSH key used to configure and connect to ' +
                         'each node (optional)', dest='sshkey',
                         default=os.path.join(os.environ['HOME'], '.ssh/id_rsa'))
 
+    parser.add_argument('-t', '--timeout', nargs=1, type=float, metavar='T',
+                        help='Budget in seconds for each client request ' +
+                        '(optional)', dest='timeout', default=[requestBudget])
+
+    parser.add_argument('--agents', nargs=1, type=str, metavar='ADDRS',
+                        help='Comma-separated addresses of load agents (agent.py) that ' +
+                        'also drive testKVS, e.g. http://host:6000', dest='agents', default=[''])
+    parser.add_argument('--results', nargs=1, type=str, metavar='DIR',
+                        help='Directory for testKVS result files', dest='results',
+                        default=[resultsDir])
+    parser.add_argument('--compare', nargs=2, type=str, metavar=('BASE', 'NEW'),
+                        help='Compare two testKVS result files and exit; the exit ' +
+                        'status is 1 if there are regressions', dest='compare')
+    parser.add_argument('--threshold', nargs=1, type=float, metavar='PCT',
+                        help='Percent change that counts as a regression in --compare',
+                        dest='threshold', default=[5.0])
+    parser.add_argument('--local', action='store_true',
+                        help='Run the frontend, servers and clients as local ' +
+                        'processes instead of Kubernetes pods', dest='local')
+    parser.add_argument('--frontend-args', nargs=1, type=str, metavar='ARGS',
+                        help='Extra arguments for local frontend processes', dest='frontendArgs',
+                        default=[''])
+    parser.add_argument('--server-args', nargs=1, type=str, metavar='ARGS',
+                        help='Extra arguments for local server processes', dest='serverArgs',
+                        default=[''])
+    parser.add_argument('--client-args', nargs=1, type=str, metavar='ARGS',
+                        help='Extra arguments for local client processes', dest='clientArgs',
+                        default=[''])
+
     args = parser.parse_args()
 
-    prefix = os.environ['KVS_HOME']
+    if args.compare is not None:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold[0]) > 0 else 0)
+    if args.client is None or args.server is None:
+        parser.error('the following arguments are required: -c/--client, -s/--server')
 
-    k8s_client, k8s_apps_client = util.init_k8s()
+    requestBudget = args.timeout[0]
+    resultsDir = args.results[0]
+    agents = [addr for addr in args.agents[0].split(',') if addr != '']
+
+    if args.local:
+        prefix = os.path.dirname(os.path.abspath(__file__))
+        localArgs['frontend'] = shlex.split(args.frontendArgs[0])
+        localArgs['server'] = shlex.split(args.serverArgs[0])
+        localArgs['client'] = shlex.split(args.clientArgs[0])
+        localDir = tempfile.mkdtemp(prefix='kvs-')
+        print('Node logs are in ' + localDir)
+        atexit.register(stop_processes)
+        k8s_client, k8s_apps_client = None, None
+    else:
+        if 'KVS_HOME' not in os.environ:
+            os.environ['KVS_HOME'] = "/home/" + os.environ['USER'] + "/projects/cs380d-f23/project1/"
+        prefix = os.environ['KVS_HOME']
+        k8s_client, k8s_apps_client = util.init_k8s()
 
     init_cluster(k8s_client, k8s_apps_client, args.client[0], args.server[0], args.sshkey, prefix)
 
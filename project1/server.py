@@ -1,41 +1,375 @@
 import argparse
+import random
+import threading
+import time
 import xmlrpc.client
 import xmlrpc.server
+from socketserver import ThreadingMixIn
+
+from shared import rpc
+from shared.cache import sizeof
+from shared.rpc import Deadline
+from shared.merkle import MerkleTree
+
 serverId = 0
 basePort = 9000
+baseAddr = "http://localhost:"
+
+
+# Requests are served concurrently so that chain puts overlap; kvs, versions
+# and tree stay guarded by KVSRPCServer.lock.
+class SimpleThreadedXMLRPCServer(ThreadingMixIn, xmlrpc.server.SimpleXMLRPCServer):
+    # Concurrent callers would overflow the default listen backlog of 5
+    request_queue_size = 128
 
 
 class KVSRPCServer:
 
-    def __init__(self):
+    def __init__(self, anti_entropy_interval=0):
         self.kvs = {}
+        # Per-key versions assigned by the frontend
+        self.versions = {}
         self.shutdown = False
+        # Keys per get_entries call when pulling from a peer
+        self.sync_batch = 10000
+        self.sync_timeout = 30.0
+        # Guards kvs/versions/tree against the anti-entropy thread. Never held
+        # across an RPC, since the peer may be calling us at the same time.
+        self.lock = threading.Lock()
+        # Merkle tree over (key, version), compared with peers pushed by the frontend
+        self.tree = MerkleTree()
+        self.peers = []
+        # Replacement data and versions being staged by the frontend
+        self.staged = ({}, {})
+        # Idle proxies to chain successors: id -> list. A forward checks one
+        # out, so puts in flight down the chain each have their own.
+        self.sLock = threading.Lock()
+        self.successors = {}
+        # Primary-backup: as primary, puts not yet shipped to the backups, in
+        # order, as [key, value, version, seq]. seq is the highest frontend
+        # sequence number applied here, used to pick a backup on failover.
+        self.seq = 0
+        self.backlog = []
+        self.backups = []
+        self.dropped = set()
+        self.ship_batch = 1000
+        self.ship_timeout = 1.0
+        self.shipped = threading.Condition(self.lock)
+        # Epoch of the frontend's reader map; clients reading directly must
+        # not be behind it
+        self.epoch = 0
+        # Direct reads are served only until reader_until (monotonic), a lease
+        # the frontend renews while this server is a reader
+        self.reader_until = 0.0
+        thread = threading.Thread(target=self.ship_loop)
+        thread.daemon = True
+        thread.start()
+        self.metrics = {"anti_entropy_sessions": 0, "anti_entropy_keys": 0}
+        if anti_entropy_interval > 0:
+            thread = threading.Thread(target=self.anti_entropy_loop, args=(anti_entropy_interval,))
+            thread.daemon = True
+            thread.start()
+
+    def update_data(self, data, versions=None):
+        with self.lock:
+            self.kvs = data
+            self.versions = {} if versions is None else versions
+            self.tree.clear()
+            for key in self.kvs:
+                self.tree.update(key, self.versions.get(key, 0))
+        return "Success"
+
+    # stage: Collect replacement data in batches, starting afresh with the
+    # first one, for swap to put in place at once.
+    def stage(self, data, versions, first=False):
+        with self.lock:
+            if first:
+                self.staged = ({}, {})
+            self.staged[0].update(data)
+            self.staged[1].update(versions)
+        return "Success"
 
-    def update_data(self, data):
-        self.kvs = data
+    # swap: Replace the data with what was staged, keeping keys written here
+    # meanwhile with a newer version.
+    def swap(self):
+        with self.lock:
+            data, versions = self.staged
+            self.staged = ({}, {})
+            for key, version in self.versions.items():
+                if version > versions.get(key, 0):
+                    data[key] = self.kvs[key]
+                    versions[key] = version
+            self.kvs = data
+            self.versions = versions
+            self.tree.clear()
+            for key in self.kvs:
+                self.tree.update(key, self.versions.get(key, 0))
+        return "Success"
+
+    # apply: Store a value unless a newer version is already here. Version 0
+    # means unversioned and always applies. Caller holds lock.
+    def apply(self, key, value, version):
+        if version == 0 or version >= self.versions.get(key, 0):
+            self.kvs[key] = value
+            if version != 0:
+                self.versions[key] = version
+            self.tree.update(key, self.versions.get(key, 0))
+
+    # put_many: Insert or update a batch of key-value pairs.
+    def put_many(self, data, versions=None):
+        with self.lock:
+            for key, value in data.items():
+                self.apply(key, value, 0 if versions is None else versions.get(key, 0))
         return "Success"
 
     # put: Insert a new-key-value pair or updates an existing
     # one with new one if the same key already exists.
-    def put(self, key, value):
-        self.kvs[key] = value
-        return "[Server " + str(serverId) + "] Receive a put request: " + "Key = " + str(key) + ", Value = " + str(value)
+    def put(self, key, value, version=0):
+        with self.lock:
+            self.apply(key, value, version)
+        shown = f"<{sizeof(value)} bytes>" if rpc.is_binary(value) else str(value)
+        return "[Server " + str(serverId) + "] Receive a put request: " + "Key = " + str(key) + ", Value = " + shown
+
+    # chain_put: Apply a put and pass it down the rest of the chain, waiting
+    # hop seconds per server still to go, so the server nearest a broken
+    # link times out first. The tail's "Success" travels back up as the
+    # acknowledgement; an unreachable successor is reported as ERR_CHAIN:<id>.
+    # Concurrent puts travel down the chain together; versions order them.
+    def chain_put(self, key, value, version, rest, hop):
+        with self.lock:
+            self.apply(key, value, version)
+        if len(rest) == 0:
+            return "Success"
+        with self.sLock:
+            idle = self.successors.setdefault(rest[0], [])
+            successor = idle.pop() if len(idle) > 0 else rpc.proxy(baseAddr + str(basePort + rest[0]))
+        try:
+            rpc.set_timeout(successor, hop * len(rest))
+            result = successor.chain_put(key, value, version, rest[1:], hop)
+        except Exception:
+            return f"ERR_CHAIN:{rest[0]}"
+        with self.sLock:
+            self.successors[rest[0]].append(successor)
+        return result
+
+    # primary_put: As primary, apply and acknowledge a put and queue it for
+    # the backups, which the frontend sends with every put. Once more than
+    # max_lag puts are queued the put waits for the shipper, and if that takes
+    # half the budget the backups are dropped. Dropped backups are reported
+    # as LAGGING:<ids> until the frontend repairs them (resume) or stops
+    # sending them.
+    def primary_put(self, key, value, version, seq, backups, max_lag, budget):
+        deadline = Deadline(budget)
+        with self.shipped:
+            self.apply(key, value, version)
+            self.seq = max(self.seq, seq)
+            self.dropped &= set(backups)
+            self.backups = [i for i in backups if i not in self.dropped]
+            if len(self.backups) > 0:
+                self.backlog.append([key, value, version, seq])
+                self.shipped.notify_all()
+            if not self.shipped.wait_for(lambda: len(self.backlog) <= max_lag, deadline.remaining() / 2):
+                self.drop(self.backups)
+            if len(self.dropped) > 0:
+                return "LAGGING:" + ",".join(str(i) for i in sorted(self.dropped))
+        return "Success"
+
+    # resume: The frontend has repaired these dropped backups: ship to them
+    # again.
+    def resume(self, backups):
+        with self.shipped:
+            self.dropped -= set(backups)
+        return "Success"
+
+    # drop: Stop shipping to the given backups. Caller holds lock.
+    def drop(self, backups):
+        self.dropped |= set(backups)
+        self.backups = [i for i in self.backups if i not in self.dropped]
+        self.shipped.notify_all()
+
+    # ship_loop: Send the backlog to the backups in order, a batch at a time.
+    # A backup that cannot take a batch is dropped.
+    def ship_loop(self):
+        proxies = {}
+        while not self.shutdown:
+            with self.shipped:
+                self.shipped.wait_for(lambda: len(self.backlog) > 0, 1.0)
+                batch = self.backlog[:self.ship_batch]
+                backups = list(self.backups)
+            if len(batch) == 0:
+                continue
+            failed = []
+            for i in backups:
+                if i not in proxies:
+                    proxies[i] = rpc.proxy(baseAddr + str(basePort + i), self.ship_timeout)
+                try:
+                    proxies[i].apply_batch(batch)
+                except Exception:
+                    failed.append(i)
+            with self.shipped:
+                del self.backlog[:len(batch)]
+                self.drop(failed)
+
+    # apply_batch: As backup, apply a batch of the primary's operation log.
+    def apply_batch(self, ops):
+        with self.lock:
+            for key, value, version, seq in ops:
+                self.apply(key, value, version)
+                self.seq = max(self.seq, seq)
+        return "Success"
+
+    # get_seq: Highest frontend sequence number applied here.
+    def get_seq(self):
+        return self.seq
 
-    # get: Get the value associated with the given key.
+    # get: Get the value associated with the given key. Binary values are
+    # returned as they are, others as strings.
     def get(self, key):
-        return f"{self.kvs.get(key, 'ERR_KEY')}"
+        value = self.kvs.get(key, 'ERR_KEY')
+        return value if rpc.is_binary(value) else f"{value}"
+
+    # get_many: Values of the given keys held here, as get formats them.
+    def get_many(self, keys):
+        with self.lock:
+            return {k: self.kvs[k] if rpc.is_binary(self.kvs[k]) else f"{self.kvs[k]}"
+                    for k in keys if k in self.kvs}
+
+    # set_epoch: The frontend announces a new reader map, with a reader
+    # lease of lease seconds if this server is a reader in it.
+    def set_epoch(self, epoch, lease=0):
+        with self.lock:
+            if epoch >= self.epoch:
+                self.epoch = epoch
+                self.reader_until = time.monotonic() + lease if lease > 0 else 0.0
+        return "Success"
+
+    # get_direct: get for clients that bypass the frontend. ERR_EPOCH tells
+    # a client with an older map, or any client once the reader lease has
+    # run out, that this server may no longer be a reader.
+    def get_direct(self, key, epoch):
+        if epoch < self.epoch or time.monotonic() > self.reader_until:
+            return "ERR_EPOCH"
+        return self.get(key)
+
+    # get_versions: Versions of the given keys, or of every key.
+    def get_versions(self, keys=None):
+        with self.lock:
+            if keys is None:
+                return dict(self.versions)
+            return {k: self.versions[k] for k in keys if k in self.versions}
+
+    # get_entries: [version, value] of each of the given keys held here.
+    def get_entries(self, keys):
+        with self.lock:
+            return {k: [self.versions.get(k, 0), self.kvs[k]] for k in keys if k in self.kvs}
+
+    # sync_from: Pull every key (or just the given keys) for which the peer
+    # holds a newer version. Values travel server to server; the frontend
+    # only names the peer.
+    def sync_from(self, peerId, keys=None):
+        peer = rpc.proxy(baseAddr + str(basePort + peerId), self.sync_timeout)
+        peerVersions = peer.get_versions() if keys is None else peer.get_versions(keys)
+        with self.lock:
+            stale = [k for k, v in peerVersions.items() if v > self.versions.get(k, 0)]
+        self.pull(peer, stale)
+        return "Success"
+
+    def pull(self, peer, keys):
+        for start in range(0, len(keys), self.sync_batch):
+            entries = peer.get_entries(keys[start:start + self.sync_batch])
+            with self.lock:
+                for k, (version, value) in entries.items():
+                    self.apply(k, value, version)
+
+    # set_peers: Membership pushed by the frontend for anti-entropy.
+    def set_peers(self, peers):
+        self.peers = [i for i in peers if i != serverId]
+        return "Success"
+
+    # merkle_nodes: Hashes of the given tree nodes.
+    def merkle_nodes(self, nodes):
+        with self.lock:
+            return self.tree.hashes(nodes)
+
+    # merkle_buckets: key -> version for the given leaf buckets.
+    def merkle_buckets(self, buckets):
+        with self.lock:
+            return self.tree.bucket_versions(buckets)
+
+    # anti_entropy: Reconcile with one peer without the frontend. Walk both
+    # Merkle trees from the root, descending only into nodes whose hashes
+    # differ, then swap the versions of the differing leaf buckets and move
+    # each key towards whichever side has the newer version. Traffic is
+    # proportional to the differences, not to the data.
+    def anti_entropy(self, peerId):
+        peer = rpc.proxy(baseAddr + str(basePort + peerId), self.sync_timeout)
+        leaves = self.tree.leaves
+        frontier = [1]
+        buckets = []
+        while len(frontier) > 0:
+            theirs = peer.merkle_nodes(frontier)
+            with self.lock:
+                mine = self.tree.hashes(frontier)
+            differing = [i for i, a, b in zip(frontier, mine, theirs) if a != b]
+            buckets += [i - leaves for i in differing if i >= leaves]
+            frontier = [c for i in differing if i < leaves for c in (2 * i, 2 * i + 1)]
+        if len(buckets) == 0:
+            return 0
+        theirs = peer.merkle_buckets(buckets)
+        with self.lock:
+            mine = self.tree.bucket_versions(buckets)
+            push = [k for k, v in mine.items() if v > theirs.get(k, -1)]
+            data = {k: self.kvs[k] for k in push}
+            versions = {k: mine[k] for k in push}
+        pull = [k for k, v in theirs.items() if v > mine.get(k, -1)]
+        self.pull(peer, pull)
+        if len(push) > 0:
+            peer.put_many(data, versions)
+        return len(pull) + len(push)
+
+    # anti_entropy_loop: Every interval, run a session with a random peer.
+    def anti_entropy_loop(self, interval):
+        while not self.shutdown:
+            time.sleep(interval)
+            peers = list(self.peers)
+            if len(peers) == 0:
+                continue
+            try:
+                repaired = self.anti_entropy(random.choice(peers))
+                self.metrics["anti_entropy_sessions"] += 1
+                self.metrics["anti_entropy_keys"] += repaired
+            except Exception:
+                pass
+
+    # getMetrics: Counters, and the keys and value bytes held here.
+    def getMetrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics["keys"] = len(self.kvs)
+            # xmlrpc ints are 32 bits
+            metrics["value_bytes"] = float(sum(sizeof(v) for v in self.kvs.values()))
+        return metrics
 
     # printKVPairs: Print all the key-value pairs at this server.
     def printKVPairs(self):
-        return '\n'.join([f"{k}:{v}" for k, v in self.kvs.items()]) + "\n"
+        with self.lock:
+            return '\n'.join([f"{k}:{v}" for k, v in self.kvs.items()]) + "\n"
 
     # shutdownServer: Terminate the server itself normally.
     def shutdownServer(self):
-        self.kvs = {}
+        with self.lock:
+            self.kvs = {}
+            self.versions = {}
+            self.tree.clear()
+            self.backlog = []
         self.shutdown = True
         return "[Server " + str(serverId) + "] Receive a request for a normal shutdown"
 
-    def heartbeat(self):
+    # heartbeat: The frontend's heartbeat, which renews the reader lease of
+    # the readers of the current epoch.
+    def heartbeat(self, epoch=0, lease=0):
+        if lease > 0:
+            self.set_epoch(epoch, lease)
         return "Sucess"
 
     def should_shutdown(self):
@@ -47,14 +381,16 @@ if __name__ == '__main__':
 
     parser.add_argument('-i', '--id', nargs=1, type=int, metavar='I',
                         help='Server id (required)', dest='serverId', required=True)
+    parser.add_argument('-a', '--anti-entropy', nargs=1, type=float, metavar='S',
+                        help='Seconds between anti-entropy sessions with a peer (0 disables)',
+                        dest='antiEntropy', default=[0])
 
     args = parser.parse_args()
 
     serverId = args.serverId[0]
 
-    server = xmlrpc.server.SimpleXMLRPCServer(
-        ("localhost", basePort + serverId))
-    server_instance = KVSRPCServer()
+    server = SimpleThreadedXMLRPCServer(("localhost", basePort + serverId))
+    server_instance = KVSRPCServer(args.antiEntropy[0])
     server.register_instance(server_instance)
     # Serve until we get a shutdown request
     while server_instance.should_shutdown() == "False":
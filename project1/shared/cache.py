@@ -0,0 +1,69 @@
+import collections
+import threading
+import xmlrpc.client
+
+
+# sizeof: Bytes a key or value costs in a cache. Values are whatever came
+# off the wire (int, str or binary), or tuples and lists of them such as a
+# (version, value) log entry, which cost the sum of their elements.
+def sizeof(value):
+    if isinstance(value, xmlrpc.client.Binary):
+        value = value.data
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(sizeof(element) for element in value)
+    return len(str(value).encode())
+
+
+# ByteLRUCache: LRU cache bounded by the total size of its keys and values.
+class ByteLRUCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # get: Return (True, value) on a hit and (False, None) on a miss.
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self.entries[key]
+
+    def put(self, key, value):
+        cost = sizeof(key) + sizeof(value)
+        with self.lock:
+            self.discard_locked(key)
+            if cost > self.capacity:
+                return
+            self.entries[key] = value
+            self.size += cost
+            while self.size > self.capacity:
+                oldKey, oldValue = self.entries.popitem(last=False)
+                self.size -= sizeof(oldKey) + sizeof(oldValue)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.discard_locked(key)
+
+    def discard_locked(self, key):
+        if key in self.entries:
+            self.size -= sizeof(key) + sizeof(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self.entries), "bytes": self.size}
@@ -0,0 +1,97 @@
+import math
+
+# Percentiles every report shows
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+# Histogram: Latency histogram in the style of HdrHistogram. Values are
+# recorded in microseconds into log-linear buckets: each power of two is
+# split into 2**(precision-1) equal buckets, so any value is reported
+# within 1/2**(precision-1) of its true size however large it gets.
+# Buckets are a sparse dict, and histograms with the same precision merge
+# by adding counts, so each thread keeps its own and they are merged after
+# a run.
+class Histogram:
+    def __init__(self, precision=8):
+        self.precision = precision
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    # bucket: Lowest value of the bucket holding value.
+    def bucket(self, value):
+        shift = max(0, value.bit_length() - self.precision)
+        return (value >> shift) << shift
+
+    def width(self, bucket):
+        return 1 << max(0, bucket.bit_length() - self.precision)
+
+    # record: Record a latency given in seconds.
+    def record(self, seconds, n=1):
+        value = max(0, int(seconds * 1e6))
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + n
+        self.count += n
+        self.total += value * n
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("histograms of different precision")
+        for bucket, n in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    # to_dict: Plain form that survives pickling and xmlrpc (string keys,
+    # no None, and a float total since xmlrpc ints are only 32 bits).
+    def to_dict(self):
+        return {"precision": self.precision, "count": self.count, "total": float(self.total),
+                "min": 0 if self.min is None else self.min, "max": self.max,
+                "counts": {str(bucket): n for bucket, n in self.counts.items()}}
+
+    @staticmethod
+    def from_dict(data):
+        histogram = Histogram(data["precision"])
+        histogram.counts = {int(bucket): n for bucket, n in data["counts"].items()}
+        histogram.count = data["count"]
+        histogram.total = int(data["total"])
+        histogram.min = data["min"] if data["count"] > 0 else None
+        histogram.max = data["max"]
+        return histogram
+
+    # percentile: Value (microseconds) at or below which p percent of the
+    # recorded values lie, as the middle of its bucket.
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        rank = max(1, math.ceil(self.count * p / 100.0))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.max, bucket + (self.width(bucket) - 1) // 2)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0
+
+    # summary: count, mean, percentiles and max, in milliseconds.
+    def summary(self):
+        result = {"count": self.count, "mean": round(self.mean() / 1000, 3)}
+        for p in PERCENTILES:
+            result[f"p{p:g}"] = round(self.percentile(p) / 1000, 3)
+        result["max"] = round(self.max / 1000, 3)
+        return result
+
+    def format(self):
+        summary = self.summary()
+        return f"count={summary['count']} " + " ".join(
+            f"{name}={value}" for name, value in summary.items() if name != "count")
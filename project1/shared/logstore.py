@@ -0,0 +1,183 @@
+import hashlib
+import marshal
+import math
+import os
+import struct
+import threading
+import xmlrpc.client
+
+from shared.cache import ByteLRUCache
+
+# Record header: key length, value length
+HEADER = struct.Struct(">II")
+
+
+# plain: Unwrap xmlrpc Binary values (also inside tuples and lists) for marshal.
+def plain(value):
+    if isinstance(value, xmlrpc.client.Binary):
+        return value.data
+    if isinstance(value, (tuple, list)):
+        return type(value)(plain(v) for v in value)
+    return value
+
+
+# BloomFilter: Answers "definitely absent" for keys that were never added.
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        self.nbits = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nhashes = max(1, int(round(self.nbits / self.capacity * math.log(2))))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    # Double hashing: the i-th probe is h1 + i * h2
+    def probes(self, key):
+        digest = hashlib.md5(key.encode()).digest()
+        h1, h2 = struct.unpack(">QQ", digest)
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def add(self, key):
+        for bit in self.probes(key):
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[bit >> 3] & (1 << (bit & 7)) for bit in self.probes(key))
+
+
+# LogStore: Append-only file of key/value records with an in-memory
+# key -> (offset, length) index, a small cache of hot values and a Bloom
+# filter in front of the index. Behaves like the dict it replaces for the
+# operations the frontend uses, so memory grows with the number of keys
+# rather than with the size of the values.
+class LogStore:
+    def __init__(self, path, cache_bytes=8 * 1024 * 1024, capacity=1 << 20):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = {}
+        self.cache = ByteLRUCache(cache_bytes)
+        self.bloom = BloomFilter(capacity)
+        self.dead = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.end = self.recover()
+
+    # recover: Rebuild the index from an existing file. A torn record at the
+    # tail (crash mid-append) is cut off.
+    def recover(self):
+        offset = 0
+        size = os.fstat(self.fd).st_size
+        while offset + HEADER.size <= size:
+            klen, vlen = HEADER.unpack(os.pread(self.fd, HEADER.size, offset))
+            if offset + HEADER.size + klen + vlen > size:
+                break
+            key = os.pread(self.fd, klen, offset + HEADER.size).decode()
+            self.track(key, offset + HEADER.size + klen, vlen)
+            offset += HEADER.size + klen + vlen
+        if offset != size:
+            os.ftruncate(self.fd, offset)
+        return offset
+
+    def track(self, key, offset, length):
+        if key in self.index:
+            self.dead += self.index[key][1]
+        else:
+            if self.bloom.count >= self.bloom.capacity:
+                self.grow_bloom()
+            self.bloom.add(key)
+        self.index[key] = (offset, length)
+
+    def grow_bloom(self):
+        bloom = BloomFilter(self.bloom.capacity * 2)
+        for key in self.index:
+            bloom.add(key)
+        self.bloom = bloom
+
+    def encode(self, key, value):
+        kdata = key.encode()
+        vdata = marshal.dumps(plain(value))
+        return HEADER.pack(len(kdata), len(vdata)) + kdata + vdata, len(kdata), len(vdata)
+
+    def __setitem__(self, key, value):
+        record, klen, vlen = self.encode(key, value)
+        with self.lock:
+            os.write(self.fd, record)
+            self.track(key, self.end + HEADER.size + klen, vlen)
+            self.end += len(record)
+            self.cache.put(key, value)
+        if self.dead > 64 * 1024 * 1024 and self.dead > self.end // 2:
+            self.compact()
+
+    # update: Append many records with a single write.
+    def update(self, data):
+        records = []
+        with self.lock:
+            offset = self.end
+            for key, value in data.items():
+                record, klen, vlen = self.encode(key, value)
+                self.track(key, offset + HEADER.size + klen, vlen)
+                offset += len(record)
+                records.append(record)
+            os.write(self.fd, b"".join(records))
+            self.end = offset
+            for key in data:
+                self.cache.discard(key)
+
+    def __getitem__(self, key):
+        hit, value = self.cache.get(key)
+        if hit:
+            return value
+        with self.lock:
+            offset, length = self.index[key]
+            value = marshal.loads(os.pread(self.fd, length, offset))
+            self.cache.put(key, value)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    # Bloom filter first: misses never touch the index
+    def __contains__(self, key):
+        return key in self.bloom and key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index.keys())
+
+    # items: Stream every live record in file order.
+    def items(self):
+        with self.lock:
+            keys = sorted(self.index, key=lambda key: self.index[key][0])
+        for key in keys:
+            with self.lock:
+                if key not in self.index:
+                    continue
+                offset, length = self.index[key]
+                data = os.pread(self.fd, length, offset)
+            yield key, marshal.loads(data)
+
+    # compact: Rewrite the file with only live records once more than half of
+    # it is overwritten values.
+    def compact(self):
+        with self.lock:
+            tmpPath = self.path + ".compact"
+            tmp = os.open(tmpPath, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+            index = {}
+            offset = 0
+            for key, (valueOffset, length) in sorted(self.index.items(), key=lambda item: item[1][0]):
+                kdata = key.encode()
+                record = HEADER.pack(len(kdata), length) + kdata + os.pread(self.fd, length, valueOffset)
+                os.write(tmp, record)
+                index[key] = (offset + HEADER.size + len(kdata), length)
+                offset += len(record)
+            os.fsync(tmp)
+            os.rename(tmpPath, self.path)
+            os.close(self.fd)
+            self.fd = tmp
+            self.index = index
+            self.end = offset
+            self.dead = 0
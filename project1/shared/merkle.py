@@ -0,0 +1,60 @@
+import hashlib
+
+# Depth every server uses, so that trees of peers line up node for node
+MERKLE_DEPTH = 10
+
+
+def entry_hash(key, version):
+    return int.from_bytes(hashlib.sha1(f"{key}:{version}".encode()).digest(), "big")
+
+
+def bucket_of(key, leaves):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:4], "big") % leaves
+
+
+# MerkleTree: Fixed-shape hash tree over the key space. Keys fall into
+# 2**depth leaf buckets by a stable hash. A leaf is the XOR of the hashes of
+# its (key, version) pairs, so updates are O(1), and inner nodes hash their
+# two children, recomputed lazily along dirty paths. Nodes use heap layout:
+# the root is 1 and node i has children 2i and 2i+1.
+class MerkleTree:
+    def __init__(self, depth=MERKLE_DEPTH):
+        self.leaves = 1 << depth
+        self.buckets = [dict() for _ in range(self.leaves)]
+        self.nodes = [0] * (2 * self.leaves)
+        self.dirty = set()
+
+    def update(self, key, version):
+        b = bucket_of(key, self.leaves)
+        bucket = self.buckets[b]
+        leaf = self.leaves + b
+        if key in bucket:
+            self.nodes[leaf] ^= entry_hash(key, bucket[key])
+        bucket[key] = version
+        self.nodes[leaf] ^= entry_hash(key, version)
+        self.dirty.add(leaf)
+
+    def clear(self):
+        self.__init__(self.leaves.bit_length() - 1)
+
+    def refresh(self):
+        level = {i // 2 for i in self.dirty}
+        self.dirty = set()
+        while len(level) > 0:
+            for i in level:
+                left, right = self.nodes[2 * i], self.nodes[2 * i + 1]
+                if left == 0 and right == 0:
+                    self.nodes[i] = 0
+                else:
+                    data = left.to_bytes(20, "big") + right.to_bytes(20, "big")
+                    self.nodes[i] = int.from_bytes(hashlib.sha1(data).digest(), "big")
+            level = {i // 2 for i in level if i > 1}
+
+    # hashes: Hex digests of the given nodes (xmlrpc ints are only 32 bits).
+    def hashes(self, nodes):
+        self.refresh()
+        return [format(self.nodes[i], "x") for i in nodes]
+
+    # bucket_versions: key -> version for every key in the given leaf buckets.
+    def bucket_versions(self, buckets):
+        return {k: v for b in buckets for k, v in self.buckets[b].items()}
@@ -0,0 +1,7 @@
+import hashlib
+
+
+# partition_of: Stable partition of a key among count owners. Frontends and
+# clients must agree on it, so it must not depend on the process (unlike hash).
+def partition_of(key, count):
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:4], "big") % count
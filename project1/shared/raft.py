@@ -0,0 +1,480 @@
+import json
+import marshal
+import os
+import random
+import struct
+import threading
+import time
+
+from shared import rpc
+from shared.logstore import plain
+
+# Record header of the persisted log: record length
+RECORD = struct.Struct(">I")
+
+
+# RaftNode: Raft consensus among a fixed group of frontends. Commands
+# proposed on the leader are appended to a replicated log, and once a
+# majority holds them they are handed to apply, in log order, on every node.
+# Elections pick a new leader within one election timeout of the old one
+# going quiet. The leader holds a read lease while a majority has heard from
+# it within lease seconds: followers refuse to vote for anyone else for
+# election_min after hearing from a leader, so no other leader can exist in
+# that time. Log entries are [term, command]. Applied entries are compacted
+# into a snapshot of the state machine (snapshot() returns one, restore()
+# installs it), which also brings followers that are too far behind up to
+# date.
+class RaftNode:
+    def __init__(self, nodeId, addrs, apply, raft_dir=None, snapshot=None, restore=None):
+        self.id = nodeId
+        self.addrs = addrs
+        self.peers = [i for i in addrs if i != nodeId]
+        self.majority = len(addrs) // 2 + 1
+        self.apply = apply
+        # Timing (seconds)
+        self.heartbeat_interval = 0.05
+        self.election_min = 0.3
+        self.election_max = 0.6
+        self.lease = 0.25
+        self.rpc_timeout = 0.2
+        self.append_timeout = 2.0
+        self.append_batch = 1000
+        self.snapshot_timeout = 30.0
+        # Log compaction: once more than snapshot_every applied entries are
+        # held they are replaced by a snapshot. base is the last index the
+        # snapshot covers and log[0] holds its term, so the entry at index i
+        # is log[i - base] (see entry).
+        self.snapshot = snapshot
+        self.restore = restore
+        self.snapshot_every = 10000
+        self.base = 0
+        # Held while commands are applied or a snapshot is taken or
+        # installed, so the state machine always matches lastApplied. Taken
+        # before lock.
+        self.applyLock = threading.Lock()
+        # Everything below is guarded by lock; changed is notified whenever
+        # the log, commit index, applied index or role changes.
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.term = 0
+        self.votedFor = None
+        self.log = [[0, None]]
+        self.commitIndex = 0
+        self.lastApplied = 0
+        self.state = "follower"
+        self.leaderId = None
+        self.lastHeard = time.monotonic()
+        # Last time a leader was heard from. A node that restarts acts as if
+        # it just heard from one, since a leader may still hold its lease.
+        self.leaderHeard = self.lastHeard
+        self.timeout = self.new_timeout()
+        self.nextIndex = {}
+        self.matchIndex = {}
+        self.acks = {}
+        # Index of the no-op a leader appends on election. Once it is applied
+        # every earlier committed command has been applied too.
+        self.termStart = 0
+        self.raft_dir = raft_dir
+        self.logFile = None
+        if raft_dir is not None:
+            self.recover()
+        threads = [self.ticker, self.applier] + [
+            (lambda peer: lambda: self.replicator(peer))(peer) for peer in self.peers]
+        for target in threads:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def new_timeout(self):
+        return random.uniform(self.election_min, self.election_max)
+
+    def last(self):
+        return self.base + len(self.log) - 1
+
+    # entry: [term, command] at index, which must not be below base.
+    def entry(self, index):
+        return self.log[index - self.base]
+
+    # is_leader: Leader whose no-op has been applied, so its state machine
+    # holds every committed command.
+    def is_leader(self):
+        with self.lock:
+            return self.state == "leader" and self.lastApplied >= self.termStart
+
+    def leader_addr(self):
+        with self.lock:
+            return self.addrs.get(self.leaderId, "")
+
+    # has_lease: A majority (counting ourselves) acknowledged an append sent
+    # within the last lease seconds.
+    def has_lease(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.state != "leader":
+                return False
+            acks = sorted([now] + [self.acks.get(i, 0) for i in self.peers], reverse=True)
+            return now - acks[self.majority - 1] < self.lease
+
+    # propose: Append a command on the leader. Returns (index, term), or None
+    # when this node is not the leader.
+    def propose(self, command):
+        with self.lock:
+            if self.state != "leader":
+                return None
+            self.log.append([self.term, command])
+            self.persist_entries(self.last(), self.log[-1:])
+            if len(self.peers) == 0:
+                self.commitIndex = self.last()
+            self.changed.notify_all()
+            return self.last(), self.term
+
+    # wait: Block until the entry proposed at (index, term) has been applied.
+    # False if it was overwritten by another leader or the deadline passed.
+    # Once compacted the entry is known to be ours only while we still lead
+    # in term.
+    def wait(self, index, term, deadline):
+        with self.lock:
+            self.changed.wait_for(lambda: self.lastApplied >= index or self.last() < index
+                                  or self.entry(index)[0] != term, deadline.remaining())
+            if index <= self.base:
+                return self.state == "leader" and self.term == term
+            return self.lastApplied >= index and self.last() >= index and self.entry(index)[0] == term
+
+    # Caller holds lock
+    def become_follower(self, term):
+        if term > self.term:
+            self.term = term
+            self.votedFor = None
+            self.persist_state()
+        if self.state != "follower":
+            self.state = "follower"
+            self.changed.notify_all()
+
+    # ticker: Start an election when no leader has been heard from within the
+    # election timeout.
+    def ticker(self):
+        while True:
+            time.sleep(0.01)
+            with self.lock:
+                if self.state == "leader" or time.monotonic() - self.lastHeard < self.timeout:
+                    continue
+                self.state = "candidate"
+                self.term += 1
+                self.votedFor = self.id
+                self.persist_state()
+                self.leaderId = None
+                self.lastHeard = time.monotonic()
+                self.timeout = self.new_timeout()
+                term = self.term
+                lastIndex, lastTerm = self.last(), self.log[-1][0]
+            self.election(term, lastIndex, lastTerm)
+
+    def election(self, term, lastIndex, lastTerm):
+        votes = [1]
+
+        def ask(peer):
+            try:
+                reply = rpc.proxy(self.addrs[peer], self.rpc_timeout).raft_vote(
+                    term, self.id, lastIndex, lastTerm)
+            except Exception:
+                return
+            with self.lock:
+                if reply[0] > self.term:
+                    self.become_follower(reply[0])
+                    return
+                if not reply[1] or self.state != "candidate" or self.term != term:
+                    return
+                votes[0] += 1
+                if votes[0] >= self.majority:
+                    self.become_leader()
+
+        if votes[0] >= self.majority:
+            with self.lock:
+                if self.state == "candidate" and self.term == term:
+                    self.become_leader()
+        for peer in self.peers:
+            thread = threading.Thread(target=ask, args=(peer,))
+            thread.daemon = True
+            thread.start()
+
+    # Caller holds lock
+    def become_leader(self):
+        self.state = "leader"
+        self.leaderId = self.id
+        self.nextIndex = {i: self.last() + 1 for i in self.peers}
+        self.matchIndex = {i: 0 for i in self.peers}
+        self.acks = {}
+        self.log.append([self.term, ["noop"]])
+        self.persist_entries(self.last(), self.log[-1:])
+        self.termStart = self.last()
+        if len(self.peers) == 0:
+            self.commitIndex = self.last()
+        self.changed.notify_all()
+
+    # replicator: Keep one peer's log in step with ours while leader; an empty
+    # append every heartbeat_interval doubles as the heartbeat.
+    def replicator(self, peer):
+        proxy = rpc.proxy(self.addrs[peer], self.append_timeout)
+        while True:
+            with self.lock:
+                self.changed.wait_for(lambda: self.state == "leader" and
+                                      self.nextIndex.get(peer, 0) <= self.last(),
+                                      self.heartbeat_interval)
+                if self.state != "leader":
+                    continue
+                term = self.term
+                prevIndex = self.nextIndex[peer] - 1
+                compacted = prevIndex < self.base
+                if not compacted:
+                    prevTerm = self.entry(prevIndex)[0]
+                    entries = self.log[prevIndex + 1 - self.base:prevIndex + 1 - self.base + self.append_batch]
+                    commit = self.commitIndex
+            if compacted:
+                self.send_snapshot(peer, term)
+                continue
+            sent = time.monotonic()
+            try:
+                reply = proxy.raft_append(term, self.id, prevIndex, prevTerm, entries, commit)
+            except Exception:
+                time.sleep(self.heartbeat_interval)
+                continue
+            with self.lock:
+                if reply[0] > self.term:
+                    self.become_follower(reply[0])
+                    continue
+                if self.state != "leader" or self.term != term:
+                    continue
+                self.acks[peer] = sent
+                if not reply[1]:
+                    self.nextIndex[peer] = max(1, reply[2])
+                    continue
+                self.matchIndex[peer] = reply[2]
+                self.nextIndex[peer] = reply[2] + 1
+                self.advance_commit()
+
+    # send_snapshot: Bring a peer whose next entry has been compacted away up
+    # to date with a snapshot of the state machine as of lastApplied.
+    def send_snapshot(self, peer, term):
+        with self.applyLock:
+            with self.lock:
+                index = self.lastApplied
+                lastTerm = self.entry(index)[0]
+            data = self.snapshot()
+        sent = time.monotonic()
+        try:
+            reply = rpc.proxy(self.addrs[peer], self.snapshot_timeout).raft_snapshot(
+                term, self.id, index, lastTerm, data)
+        except Exception:
+            time.sleep(self.heartbeat_interval)
+            return
+        with self.lock:
+            if reply[0] > self.term:
+                self.become_follower(reply[0])
+                return
+            if self.state != "leader" or self.term != term:
+                return
+            self.acks[peer] = sent
+            self.matchIndex[peer] = max(self.matchIndex[peer], index)
+            self.nextIndex[peer] = max(self.nextIndex[peer], index + 1)
+            self.advance_commit()
+
+    # Caller holds lock. Only entries of the current term are committed by
+    # counting replicas; earlier ones commit along with them.
+    def advance_commit(self):
+        matches = sorted([self.last()] + list(self.matchIndex.values()), reverse=True)
+        index = matches[self.majority - 1]
+        if index > self.commitIndex and self.entry(index)[0] == self.term:
+            self.commitIndex = index
+            self.changed.notify_all()
+
+    # applier: Hand committed commands to apply in order, then compact the
+    # log if it has grown enough. apply runs without lock so that it may
+    # take the caller's own locks.
+    def applier(self):
+        while True:
+            with self.lock:
+                self.changed.wait_for(lambda: self.commitIndex > self.lastApplied)
+            with self.applyLock:
+                with self.lock:
+                    start = self.lastApplied + 1
+                    entries = self.log[start - self.base:self.commitIndex + 1 - self.base]
+                for offset, (_, command) in enumerate(entries):
+                    self.apply(command)
+                    with self.lock:
+                        self.lastApplied = start + offset
+                        self.changed.notify_all()
+                self.compact()
+
+    # compact: Once more than snapshot_every applied entries are held,
+    # replace them with a snapshot, which is persisted before the log file
+    # drops them. Entries up to lastApplied are committed, so no append can
+    # truncate them meanwhile. Caller holds applyLock.
+    def compact(self):
+        if self.snapshot is None:
+            return
+        with self.lock:
+            if self.lastApplied - self.base < self.snapshot_every:
+                return
+            index = self.lastApplied
+            term = self.entry(index)[0]
+        if self.raft_dir is not None:
+            self.persist_snapshot(index, term, self.snapshot())
+        with self.lock:
+            self.log = [[term, None]] + self.log[index + 1 - self.base:]
+            self.base = index
+            self.rewrite_log()
+
+    # raft_vote: RequestVote RPC. Returns [term, granted].
+    def raft_vote(self, term, candidateId, lastIndex, lastTerm):
+        with self.lock:
+            now = time.monotonic()
+            # A live leader's lease rests on nobody else being elected
+            if self.state == "leader" or now - self.leaderHeard < self.election_min:
+                return [self.term, False]
+            if term < self.term:
+                return [self.term, False]
+            self.become_follower(term)
+            upToDate = (lastTerm, lastIndex) >= (self.log[-1][0], self.last())
+            if self.votedFor in (None, candidateId) and upToDate:
+                self.votedFor = candidateId
+                self.persist_state()
+                self.lastHeard = now
+                return [self.term, True]
+            return [self.term, False]
+
+    # raft_append: AppendEntries RPC. Returns [term, success, index]: the
+    # last index now matching the leader, or where the leader should retry.
+    def raft_append(self, term, leaderId, prevIndex, prevTerm, entries, leaderCommit):
+        with self.lock:
+            if term < self.term:
+                return [self.term, False, 0]
+            self.become_follower(term)
+            self.leaderId = leaderId
+            self.lastHeard = self.leaderHeard = time.monotonic()
+            if prevIndex > self.last():
+                return [self.term, False, self.last() + 1]
+            # Entries up to base are committed and in our snapshot already
+            if prevIndex < self.base:
+                entries = entries[self.base - prevIndex:]
+                prevIndex, prevTerm = self.base, self.log[0][0]
+            if self.entry(prevIndex)[0] != prevTerm:
+                return [self.term, False, prevIndex]
+            for offset, entry in enumerate(entries):
+                index = prevIndex + 1 + offset
+                if index <= self.last() and self.entry(index)[0] != entry[0]:
+                    del self.log[index - self.base:]
+                    self.changed.notify_all()
+                if index > self.last():
+                    self.log += entries[offset:]
+                    self.persist_entries(index, entries[offset:])
+                    break
+            match = prevIndex + len(entries)
+            if leaderCommit > self.commitIndex:
+                self.commitIndex = max(self.commitIndex, min(leaderCommit, match))
+                self.changed.notify_all()
+            return [self.term, True, match]
+
+    # raft_snapshot: InstallSnapshot RPC. Returns [term]. Replaces the state
+    # machine and every entry up to index, unless those are applied here
+    # already; later entries are kept if they follow on from it.
+    def raft_snapshot(self, term, leaderId, index, lastTerm, data):
+        with self.lock:
+            if term < self.term:
+                return [self.term]
+            self.become_follower(term)
+            self.leaderId = leaderId
+            self.lastHeard = self.leaderHeard = time.monotonic()
+        with self.applyLock:
+            with self.lock:
+                if index <= self.lastApplied:
+                    return [self.term]
+            self.restore(data)
+            if self.raft_dir is not None:
+                self.persist_snapshot(index, lastTerm, data)
+            with self.lock:
+                if index <= self.last() and self.entry(index)[0] == lastTerm:
+                    self.log = [[lastTerm, None]] + self.log[index + 1 - self.base:]
+                else:
+                    self.log = [[lastTerm, None]]
+                self.base = index
+                self.commitIndex = max(self.commitIndex, index)
+                self.lastApplied = index
+                self.lastHeard = self.leaderHeard = time.monotonic()
+                self.rewrite_log()
+                self.changed.notify_all()
+            return [self.term]
+
+    # Persistence (raft_dir only): term and vote in a small JSON file replaced
+    # atomically, log entries appended as (index, term, command) records. A
+    # record for an index drops every later one, which replays truncations.
+    # The snapshot, (index, term, state), is also replaced atomically, and
+    # records it covers are skipped.
+    def recover(self):
+        statePath = os.path.join(self.raft_dir, f"raft-{self.id}.state")
+        if os.path.exists(statePath):
+            with open(statePath) as f:
+                state = json.load(f)
+            self.term, self.votedFor = state["term"], state["votedFor"]
+        snapshotPath = os.path.join(self.raft_dir, f"raft-{self.id}.snapshot")
+        if os.path.exists(snapshotPath):
+            with open(snapshotPath, "rb") as f:
+                index, term, data = marshal.loads(f.read())
+            self.restore(data)
+            self.base = self.commitIndex = self.lastApplied = index
+            self.log = [[term, None]]
+        logPath = os.path.join(self.raft_dir, f"raft-{self.id}.log")
+        self.logFile = open(logPath, "a+b")
+        self.logFile.seek(0)
+        data = self.logFile.read()
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            length, = RECORD.unpack_from(data, offset)
+            if offset + RECORD.size + length > len(data):
+                break
+            index, term, command = marshal.loads(data[offset + RECORD.size:offset + RECORD.size + length])
+            if index > self.base:
+                del self.log[index - self.base:]
+                self.log.append([term, command])
+            offset += RECORD.size + length
+        if offset != len(data):
+            self.logFile.truncate(offset)
+
+    def persist_state(self):
+        if self.raft_dir is None:
+            return
+        path = os.path.join(self.raft_dir, f"raft-{self.id}.state")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"term": self.term, "votedFor": self.votedFor}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+
+    def persist_entries(self, index, entries):
+        if self.logFile is None:
+            return
+        for offset, (term, command) in enumerate(entries):
+            record = marshal.dumps((index + offset, term, plain(command)))
+            self.logFile.write(RECORD.pack(len(record)) + record)
+        self.logFile.flush()
+        os.fsync(self.logFile.fileno())
+
+    def persist_snapshot(self, index, term, data):
+        path = os.path.join(self.raft_dir, f"raft-{self.id}.snapshot")
+        with open(path + ".tmp", "wb") as f:
+            f.write(marshal.dumps((index, term, plain(data))))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+
+    # rewrite_log: Replace the log file with the entries after base. Caller
+    # holds lock.
+    def rewrite_log(self):
+        if self.logFile is None:
+            return
+        path = os.path.join(self.raft_dir, f"raft-{self.id}.log")
+        self.logFile.close()
+        self.logFile = open(path + ".tmp", "w+b")
+        self.persist_entries(self.base + 1, self.log[1:])
+        self.logFile.close()
+        os.rename(path + ".tmp", path)
+        self.logFile = open(path, "a+b")
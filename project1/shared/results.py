@@ -0,0 +1,108 @@
+import json
+import os
+import subprocess
+import time
+
+# Latency percentiles compared between runs
+COMPARED = ("p50", "p99", "p99.9")
+
+
+# git_commit: Commit checked out at path, with "-dirty" when tracked files
+# have changed. None outside a git tree.
+def git_commit(path):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=path, check=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                cwd=path, check=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if status.strip() != "" else "")
+
+
+# phase_result: Throughput, errors and latency of one testKVS phase from its
+# merged histograms (failed operations are in the "<op> failed" ones).
+def phase_result(operations, elapsed, histograms, counts=None):
+    return {"operations": operations, "elapsed": round(elapsed, 3),
+            "throughput": round(operations / elapsed, 1) if elapsed > 0 else 0,
+            "errors": sum(h.count for op, h in histograms.items() if op.endswith(" failed")),
+            "counts": counts or {},
+            "latency": {op: h.summary() for op, h in histograms.items()},
+            "histograms": {op: h.to_dict() for op, h in histograms.items()}}
+
+
+def save(path, result):
+    directory = os.path.dirname(path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(result, f, indent=1, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def default_path(directory):
+    return os.path.join(directory, time.strftime("testKVS-%Y%m%d-%H%M%S.json"))
+
+
+# metrics: name -> (value, higher_is_better) for the numbers compared.
+def metrics(result):
+    values = {}
+    for phase in ("load", "run"):
+        if phase not in result:
+            continue
+        values[f"{phase} throughput"] = (result[phase]["throughput"], True)
+        values[f"{phase} errors"] = (result[phase]["errors"], False)
+        for op, summary in sorted(result[phase]["latency"].items()):
+            if op.endswith(" failed"):
+                continue
+            for p in COMPARED:
+                values[f"{phase} {op} {p}"] = (summary[p], False)
+    return values
+
+
+# compare: Rows of (metric, base, new, change in percent, verdict) for the
+# metrics both runs have. A change of more than threshold percent in the
+# bad direction is a regression; any new error is one as well.
+def compare(base, new, threshold=5.0):
+    rows = []
+    baseValues = metrics(base)
+    newValues = metrics(new)
+    for name, (before, higher) in baseValues.items():
+        if name not in newValues:
+            continue
+        after = newValues[name][0]
+        change = None if before == 0 else round((after - before) / before * 100, 1)
+        if change is None:
+            worse = after > before and not higher
+            verdict = "REGRESSION" if worse else ""
+        elif (change < -threshold) if higher else (change > threshold):
+            verdict = "REGRESSION"
+        elif (change > threshold) if higher else (change < -threshold):
+            verdict = "improved"
+        else:
+            verdict = ""
+        rows.append((name, before, after, change, verdict))
+    return rows
+
+
+# format_comparison: The rows as a table, with a warning first when the two
+# runs were not made with the same parameters.
+def format_comparison(base, new, rows):
+    lines = []
+    if base.get("parameters") != new.get("parameters"):
+        lines.append("[Warning] runs have different parameters")
+    lines.append(f"base {base.get('commit')}  new {new.get('commit')}")
+    width = max([len(row[0]) for row in rows] + [6])
+    lines.append(f"{'metric':<{width}} {'base':>10} {'new':>10} {'change':>8}")
+    for name, before, after, change, verdict in rows:
+        changed = "n/a" if change is None else f"{change:+.1f}%"
+        lines.append(f"{name:<{width}} {before:>10} {after:>10} {changed:>8} {verdict}".rstrip())
+    regressions = sum(1 for row in rows if row[4] == "REGRESSION")
+    lines.append(f"{regressions} regression(s)")
+    return "\n".join(lines)
@@ -0,0 +1,64 @@
+import time
+import xmlrpc.client
+
+# Error returned at any hop once the request budget has run out
+ERR_DEADLINE = "ERR_DEADLINE"
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# Deadline: Absolute expiry of a request within one process. Budgets are sent
+# between hops as remaining seconds so clocks never have to agree.
+class Deadline:
+    def __init__(self, budget):
+        self.expiry = time.monotonic() + budget
+
+    def remaining(self):
+        return max(0.0, self.expiry - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+# Transport whose socket timeout can be changed between calls. The stock
+# Transport blocks forever on a wedged peer.
+class TimeoutTransport(xmlrpc.client.Transport):
+    def __init__(self, timeout=None):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = super().make_connection(host)
+        conn.timeout = self.timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(self.timeout)
+        return conn
+
+
+def proxy(addr, timeout=None):
+    return xmlrpc.client.ServerProxy(addr, transport=TimeoutTransport(timeout))
+
+
+def set_timeout(server_proxy, timeout):
+    server_proxy("transport").timeout = timeout
+
+
+# is_binary: Values are ints and strings, or binary: sent as xmlrpc Binary
+# (bytes once read back from a LogStore) and passed on as they are at every
+# hop, never formatted into strings.
+def is_binary(value):
+    return isinstance(value, (bytes, bytearray, xmlrpc.client.Binary))
+
+
+# found: What a get returns for a value: "key:value", or a binary value itself.
+def found(key, value):
+    return value if is_binary(value) else f"{key}:{value}"
+
+
+# stored: What a put of a value returns. A binary value shows as its size.
+def stored(key, value):
+    if is_binary(value):
+        value = f"<{len(value.data if isinstance(value, xmlrpc.client.Binary) else value)} bytes>"
+    return f"Success put {key}:{value}"
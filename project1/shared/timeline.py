@@ -0,0 +1,109 @@
+import csv
+import json
+import threading
+
+from shared.histogram import Histogram, PERCENTILES
+
+
+# Timeline: Completed operations, errors and latency per fixed interval of
+# a run, timed from a start the driver processes share, so that timelines
+# of several processes merge interval by interval. Thread safe.
+class Timeline:
+    def __init__(self, start, interval=0.1):
+        self.start = start
+        self.interval = interval
+        self.lock = threading.Lock()
+        # interval index -> [ok, errors, Histogram]
+        self.intervals = {}
+
+    # record: An operation that completed at end (time.time()).
+    def record(self, end, seconds, ok=True):
+        index = max(0, int((end - self.start) / self.interval))
+        with self.lock:
+            if index not in self.intervals:
+                self.intervals[index] = [0, 0, Histogram()]
+            entry = self.intervals[index]
+            if ok:
+                entry[0] += 1
+                entry[2].record(seconds)
+            else:
+                entry[1] += 1
+
+    def merge(self, other):
+        with self.lock:
+            for index, (ok, errors, histogram) in other.intervals.items():
+                if index not in self.intervals:
+                    self.intervals[index] = [0, 0, Histogram()]
+                entry = self.intervals[index]
+                entry[0] += ok
+                entry[1] += errors
+                entry[2].merge(histogram)
+        return self
+
+    def to_dict(self):
+        with self.lock:
+            return {"start": self.start, "interval": self.interval,
+                    "intervals": {str(i): [ok, errors, h.to_dict()]
+                                  for i, (ok, errors, h) in self.intervals.items()}}
+
+    @staticmethod
+    def from_dict(data):
+        timeline = Timeline(data["start"], data["interval"])
+        timeline.intervals = {int(i): [ok, errors, Histogram.from_dict(h)]
+                              for i, (ok, errors, h) in data["intervals"].items()}
+        return timeline
+
+    # rows: One row per interval from the start to the last one with data,
+    # empty intervals included, with throughput in ops/sec and latency in ms.
+    def rows(self, events=()):
+        rows = []
+        last = max(self.intervals) if len(self.intervals) > 0 else -1
+        for index in range(last + 1):
+            ok, errors, histogram = self.intervals.get(index, [0, 0, Histogram()])
+            row = {"time": round(index * self.interval, 3), "ok": ok, "errors": errors,
+                   "throughput": round(ok / self.interval, 1)}
+            for p in PERCENTILES:
+                row[f"p{p:g}"] = round(histogram.percentile(p) / 1000, 3)
+            row["max"] = round(histogram.max / 1000, 3)
+            row["events"] = "; ".join(text for at, text in events
+                                      if index * self.interval <= at < (index + 1) * self.interval)
+            rows.append(row)
+        return rows
+
+    # write: Save the rows with the events marked, as JSON if path ends in
+    # .json and as CSV otherwise.
+    def write(self, path, events=()):
+        rows = self.rows(events)
+        with open(path, "w") as f:
+            if path.endswith(".json"):
+                json.dump({"interval": self.interval, "events": [list(e) for e in events],
+                           "intervals": rows}, f, indent=1)
+            else:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if len(rows) > 0 else ["time"])
+                writer.writeheader()
+                writer.writerows(rows)
+
+
+# availability: How a run fared after its first event at time failure (s).
+# Baseline is the mean throughput before it, from the first busy interval;
+# unavailability the longest stretch of intervals after it without a
+# successful operation; recovery the time until throughput is back to 90%
+# of baseline for three intervals in a row (None if it never is).
+def availability(rows, failure, interval):
+    before = [row["throughput"] for row in rows if row["time"] + interval <= failure]
+    # Not counting intervals before the drivers got going
+    while len(before) > 0 and before[0] == 0:
+        before.pop(0)
+    after = [row for row in rows if row["time"] + interval > failure]
+    baseline = sum(before) / len(before) if len(before) > 0 else 0
+    longest = current = 0
+    for row in after:
+        current = current + 1 if row["ok"] == 0 else 0
+        longest = max(longest, current)
+    recovery = None
+    for i in range(len(after) - 2):
+        if all(row["throughput"] >= 0.9 * baseline for row in after[i:i + 3]):
+            recovery = round(max(0, after[i]["time"] - failure), 3)
+            break
+    return {"baseline": round(baseline, 1), "unavailable": round(longest * interval, 3),
+            "recovery": recovery}
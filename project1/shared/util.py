@@ -1,12 +1,19 @@
 import os
+import socket
 import subprocess
 import sys
 import tarfile
+import time
 from tempfile import TemporaryFile
 import yaml
 
-import kubernetes as k8s
-from kubernetes.stream import stream
+# Only the Kubernetes backend needs the client; run_cluster.py --local
+# works without it.
+try:
+    import kubernetes as k8s
+    from kubernetes.stream import stream
+except ImportError:
+    k8s = None
 
 NAMESPACE = 'default'
 
@@ -17,6 +24,9 @@ def replace_yaml_val(yaml_dict, name, val):
             return
 
 def init_k8s():
+    if k8s is None:
+        print('The kubernetes package is not installed; use --local to run without it.')
+        sys.exit(1)
     cfg = k8s.config
     cfg.load_kube_config()
     client = k8s.client.CoreV1Api()
@@ -69,6 +79,20 @@ def check_wait_pod_status(client, selector, status):
         pod_statuses = list(filter(lambda pod: pod.status.phase != status, pod_list))
         done = len(pod_statuses) == 0
 
+# check_wait_port: Wait until a local process accepts connections on port.
+def check_wait_port(process, port, timeout=30.0):
+    start = time.time()
+    while True:
+        try:
+            socket.create_connection(('localhost', port), 1.0).close()
+            return
+        except OSError:
+            pass
+        if process.poll() is not None or time.time() - start > timeout:
+            print(f'Process {process.args} did not start listening on port {port}')
+            sys.exit(1)
+        time.sleep(0.05)
+
 def get_pod_ips(client, selector, is_running=False):
     pod_list = client.list_namespaced_pod(namespace=NAMESPACE,
                                           label_selector=selector).items
@@ -0,0 +1,235 @@
+import random
+import threading
+import xmlrpc.client
+
+# YCSB core workloads: operation mix and request distribution. "rmw" is a
+# read-modify-write of one key, "scan" reads a run of consecutive keys.
+WORKLOADS = {
+    "a": {"read": 0.5, "update": 0.5, "distribution": "zipfian"},
+    "b": {"read": 0.95, "update": 0.05, "distribution": "zipfian"},
+    "c": {"read": 1.0, "distribution": "zipfian"},
+    "d": {"read": 0.95, "insert": 0.05, "distribution": "latest"},
+    "e": {"scan": 0.95, "insert": 0.05, "distribution": "zipfian"},
+    "f": {"read": 0.5, "rmw": 0.5, "distribution": "zipfian"},
+}
+OPERATIONS = ("read", "update", "insert", "scan", "rmw")
+DISTRIBUTIONS = ("uniform", "zipfian", "latest", "hotspot")
+# Value size distributions, as YCSB's field length distributions
+VALUE_DISTRIBUTIONS = ("constant", "uniform", "zipfian")
+
+ZIPFIAN_CONSTANT = 0.99
+FNV_OFFSET = 0xCBF29CE484222325
+FNV_PRIME = 0x100000001B3
+
+
+def fnv64(value):
+    h = FNV_OFFSET
+    for _ in range(8):
+        h = ((h ^ (value & 0xff)) * FNV_PRIME) & 0xFFFFFFFFFFFFFFFF
+        value >>= 8
+    return h
+
+
+# UniformChooser: Every record equally likely.
+class UniformChooser:
+    def __init__(self, count):
+        self.count = count
+
+    def next(self, rng):
+        return rng.randrange(self.count)
+
+
+# ZipfianChooser: Rank r is chosen with probability proportional to
+# 1/(r+1)^theta, using the closed form of Gray et al. as YCSB does. With
+# scramble the ranks are hashed over the records so that the popular ones
+# are spread through the key space instead of clustered at its start.
+class ZipfianChooser:
+    def __init__(self, count, theta=ZIPFIAN_CONSTANT, scramble=True):
+        self.count = count
+        self.theta = theta
+        self.scramble = scramble
+        self.alpha = 1.0 / (1.0 - theta)
+        self.zetan = sum(1.0 / (i + 1) ** theta for i in range(count))
+        zeta2 = 1.0 + 0.5 ** theta
+        self.eta = (1.0 - (2.0 / count) ** (1.0 - theta)) / (1.0 - zeta2 / self.zetan)
+        self.half = 1.0 + 0.5 ** theta
+
+    def rank(self, rng):
+        u = rng.random()
+        uz = u * self.zetan
+        if uz < 1.0:
+            return 0
+        if uz < self.half:
+            return 1
+        return min(self.count - 1, int(self.count * (self.eta * u - self.eta + 1.0) ** self.alpha))
+
+    def next(self, rng):
+        rank = self.rank(rng)
+        return fnv64(rank) % self.count if self.scramble else rank
+
+
+# LatestChooser: Zipfian over recency, so the most recently inserted records
+# are the most popular. As with several YCSB clients, each process only
+# knows its own inserts, which rank before the initial records.
+class LatestChooser:
+    def __init__(self, count, counter):
+        self.zipfian = ZipfianChooser(count, scramble=False)
+        self.counter = counter
+
+    def next(self, rng):
+        return self.counter.recent(self.zipfian.rank(rng))
+
+
+# HotspotChooser: hot_ops of the operations go to the first hot_fraction
+# of the records, the rest to the others, uniformly within each set.
+class HotspotChooser:
+    def __init__(self, count, hot_fraction=0.2, hot_ops=0.8):
+        self.count = count
+        self.hot = max(1, int(count * hot_fraction))
+        self.hot_ops = hot_ops
+
+    def next(self, rng):
+        if self.hot == self.count or rng.random() < self.hot_ops:
+            return rng.randrange(self.hot)
+        return rng.randrange(self.hot, self.count)
+
+
+# InsertCounter: Number of records, shared by the threads of a run so that
+# inserts get fresh keys and latest follows them. Driver processes running
+# the same workload interleave their inserts: process offset of stride
+# takes records count+offset, count+offset+stride, ...
+class InsertCounter:
+    def __init__(self, count, offset=0, stride=1):
+        self.lock = threading.Lock()
+        self.initial = count
+        self.count = count
+        self.offset = offset
+        self.stride = stride
+
+    def next(self):
+        with self.lock:
+            self.count += self.stride
+            return self.count - self.stride + self.offset
+
+    def value(self):
+        with self.lock:
+            return self.count
+
+    # latest: One past the newest record inserted here. Records of other
+    # processes beyond it may not exist yet.
+    def latest(self):
+        with self.lock:
+            if self.count == self.initial:
+                return self.count
+            return self.count - self.stride + self.offset + 1
+
+    # recent: The record rank places from the newest, counting the records
+    # inserted here and then the initial ones.
+    def recent(self, rank):
+        with self.lock:
+            inserted = (self.count - self.initial) // self.stride
+        if rank < inserted:
+            return self.initial + self.offset + (inserted - 1 - rank) * self.stride
+        return max(0, self.initial - 1 - (rank - inserted))
+
+
+# Values: Binary values of size bytes, a count or a "min-max" range. Sizes
+# in a range are drawn by distribution: uniform (the default), zipfian with
+# the smallest sizes the most common, or constant at the largest. Values are
+# slices of one random block, so making them is cheap.
+class Values:
+    def __init__(self, size=100, distribution=None):
+        if isinstance(size, str) and '-' in size:
+            low, high = size.split('-', 1)
+            self.sizes = (int(low), int(high))
+        else:
+            self.sizes = (int(size), int(size))
+        if self.sizes[0] < 0 or self.sizes[0] > self.sizes[1]:
+            raise ValueError(f"bad value size {size}")
+        distribution = distribution or "uniform"
+        if distribution not in VALUE_DISTRIBUTIONS:
+            raise ValueError(f"unknown value distribution {distribution}")
+        self.distribution = distribution
+        self.zipfian = None
+        if distribution == "zipfian" and self.sizes[1] > self.sizes[0]:
+            self.zipfian = ZipfianChooser(self.sizes[1] - self.sizes[0] + 1, scramble=False)
+        length = max(self.sizes[1] * 2, 1024)
+        self.block = random.Random(0).getrandbits(length * 8).to_bytes(length, "little")
+
+    def size(self, rng):
+        low, high = self.sizes
+        if self.distribution == "constant":
+            return high
+        if self.zipfian is not None:
+            return low + self.zipfian.rank(rng)
+        return rng.randint(low, high)
+
+    def value(self, rng):
+        size = self.size(rng)
+        start = rng.randrange(len(self.block) - size + 1)
+        return xmlrpc.client.Binary(self.block[start:start + size])
+
+    # value_of: The value made from number n, the same in every process, so
+    # drivers can put and check values without shipping them around.
+    def value_of(self, n):
+        return self.value(random.Random(n))
+
+
+# Workload: A YCSB-style workload over records 0..record_count-1, given as
+# the name of a core workload or as operation proportions. Keys map record
+# numbers through keys (the shuffled key list of testKVS); inserted records
+# use their number as the key. Values are value_size bytes, drawn by
+# value_distribution (see Values).
+class Workload:
+    def __init__(self, spec, record_count, distribution=None, value_size=100,
+                 max_scan=100, keys=None, insert_offset=0, insert_stride=1,
+                 value_distribution=None):
+        if isinstance(spec, str):
+            if spec.lower() not in WORKLOADS:
+                raise ValueError(f"unknown workload {spec}")
+            spec = WORKLOADS[spec.lower()]
+        self.mix = [(op, spec[op]) for op in OPERATIONS if spec.get(op, 0) > 0]
+        if len(self.mix) == 0:
+            raise ValueError("workload has no operations")
+        self.total = sum(p for _, p in self.mix)
+        distribution = distribution or spec.get("distribution", "uniform")
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"unknown distribution {distribution}")
+        self.distribution = distribution
+        self.record_count = record_count
+        self.counter = InsertCounter(record_count, insert_offset, insert_stride)
+        if distribution == "uniform":
+            self.chooser = UniformChooser(record_count)
+        elif distribution == "zipfian":
+            self.chooser = ZipfianChooser(record_count)
+        elif distribution == "latest":
+            self.chooser = LatestChooser(record_count, self.counter)
+        else:
+            self.chooser = HotspotChooser(record_count)
+        self.max_scan = max_scan
+        self.keys = keys
+        self.values = Values(value_size, value_distribution)
+
+    def key(self, record):
+        if self.keys is not None and record < len(self.keys):
+            return self.keys[record]
+        return record
+
+    def value(self, rng):
+        return self.values.value(rng)
+
+    # next_op: The next operation as (op, key), or (op, keys) for a scan.
+    def next_op(self, rng):
+        pick = rng.random() * self.total
+        for op, p in self.mix:
+            pick -= p
+            if pick < 0:
+                break
+        if op == "insert":
+            return op, self.key(self.counter.next())
+        record = self.chooser.next(rng)
+        if op == "scan":
+            length = rng.randint(1, self.max_scan)
+            end = min(record + length, self.counter.latest())
+            return op, [self.key(r) for r in range(record, end)]
+        return op, self.key(record)